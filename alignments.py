@@ -4,19 +4,114 @@ import cross_bundle_bucket
 import pairedread
 import copy
 import random
+import samIO
+import bamIO
 import time
 
+class ReadEnds:
+    ''' View of the end positions of a list of [start, end, count] reads, so that the list can be searched with bisect '''
+
+    def __init__(self, reads):
+        self.reads = reads
+
+    def __len__(self):
+        return len(self.reads)
+
+    def __getitem__(self, i):
+        return self.reads[i][1]
+
+class ReadsByEnd:
+    ''' Index of a sorted list of unique reads by end position, for finding the reads with a positive count whose ends are closest to a given position.
+        Counts may only decrease; reads whose count reaches 0 are dropped from the index as they are found
+    '''
+
+    def __init__(self, reads, counts):
+        self.counts = counts
+
+        # Indices of the reads ending at each position, along with the range of them that may still have a positive count
+        self.ids = dict()
+        for i in range(len(reads)):
+            ids = self.ids.get(reads[i][1])
+            if ids == None:
+                self.ids[reads[i][1]] = [[i], 0, 1]
+            else:
+                ids[0].append(i)
+                ids[2] += 1
+
+        # Sorted end positions that may still have a read with a positive count
+        self.ends = sorted(self.ids)
+
+    def isActive(self, end):
+        ''' Return True if a read ending at end has a positive count
+        '''
+
+        ids = self.ids.get(end)
+        if ids == None:
+            return False
+
+        counts = self.counts
+        while ids[1] < ids[2] and counts[ids[0][ids[1]]] == 0:
+            ids[1] += 1
+        while ids[1] < ids[2] and counts[ids[0][ids[2]-1]] == 0:
+            ids[2] -= 1
+        return ids[1] < ids[2]
+
+    def first(self, end):
+        ''' Return the smallest index of a read with a positive count ending at end, or None if there is none
+        '''
+
+        if self.isActive(end):
+            ids = self.ids[end]
+            return ids[0][ids[1]]
+        return None
+
+    def last(self, end):
+        ''' Return the largest index of a read with a positive count ending at end, or None if there is none
+        '''
+
+        if self.isActive(end):
+            ids = self.ids[end]
+            return ids[0][ids[2]-1]
+        return None
+
+    def nearest(self, pos):
+        ''' Return the distance from pos to the closest end of a read with a positive count, or None if there is none
+        '''
+
+        ends = self.ends
+        d = None
+
+        k = bisect.bisect_left(ends, pos)
+        while k < len(ends):
+            if self.isActive(ends[k]):
+                d = ends[k] - pos
+                break
+            del ends[k]
+
+        k -= 1
+        while k >= 0:
+            if self.isActive(ends[k]):
+                if d == None or pos - ends[k] < d:
+                    d = pos - ends[k]
+                break
+            del ends[k]
+            k -= 1
+
+        return d
+
 class Alignments:
     ''' A set of reads aligned to a genome '''
 
-    def __init__(self, chromosomes, frag_len_cutoff=None, split_discordant=True):
+    def __init__(self, chromosomes, frag_len_cutoff=None, split_discordant=True, split_diff_strands=False):
         ''' Initialize a genome for alignments
 
             chromosomes: A dictionary with keys corresponding to chromosome names and values corresponding to lengths
+            split_diff_strands: If True, mates with different XS values found in the same bundle are converted to unpaired reads
         '''
 
         self.frag_len_cutoff = frag_len_cutoff
         self.split_discordant = split_discordant
+        self.split_diff_strands = split_diff_strands
 
         self.chromosomeNames = chromosomes[0]
         self.chromosomes = dict()
@@ -67,6 +162,9 @@ class Alignments:
 
         self.numUnmatched = 0
 
+        # Pairs on different strands whose mates lie in different bundles, which are kept paired
+        self.numCrossBundleDiffStrands = 0
+
         self.gtf_exons = []
         self.gtf_id = 0
 
@@ -112,6 +210,13 @@ class Alignments:
                     if i >= 0:
                         mate = self.unmatched[name][i]
 
+                        if self.split_diff_strands and self.diff_strands(read, mate):
+                            # Treat both mates as unpaired reads
+                            del self.unmatched[name][i]
+                            self.add_unpaired(mate)
+                            self.add_unpaired(read)
+                            return
+
                         if mate.exons[-1][1] > read.exons[-1][1]:
                             self.add_paired(read, mate)
                         else:
@@ -138,6 +243,10 @@ class Alignments:
                     if i >= 0:
                         mate = self.cross_bundle_reads[name][i]
 
+                        if self.split_diff_strands and self.diff_strands(read, mate):
+                            # The bundle containing the mate has already been compressed, so the pair is kept
+                            self.numCrossBundleDiffStrands += 1
+
                         self.cross_bundle_pairs.append((mate, read, min(read.NH, mate.NH)))
 
                         if not read.NH == mate.NH:
@@ -200,6 +309,13 @@ class Alignments:
         return -1
 
 
+    def diff_strands(self, readA, readB):
+        '''
+        Return True if the two reads have contradicting XS values
+        '''
+
+        return (readA.strand == '+' and readB.strand == '-') or (readA.strand == '-' and readB.strand == '+')
+
     def update_gene_bounds(self, start, end):
         '''
         Update the boundaries of the current bundle to include [start, end]
@@ -364,7 +480,7 @@ class Alignments:
                 strand = 1
             else:
                 strand = 0
-            key = str(p[0].bundle) + ' ' + ' '.join([str(e) for e in p[0].exonIds]) + ',' + str(p[1].bundle) + ' ' + ' '.join([str(e) for e in p[1].exonIds]) + ' ' + str(NH) + ' ' + str(strand)
+            key = (p[0].bundle, tuple(p[0].exonIds), p[1].bundle, tuple(p[1].exonIds), NH, strand)
             if key in self.cross_bundle_buckets:
                 self.cross_bundle_buckets[key].add_pair(p[0], p[1])
             else:
@@ -434,12 +550,12 @@ class Alignments:
 
         exonIds = r.exonIds
 
-        strand = '0'
+        strand = 0
         if r.strand == '-':
-            strand = '-1'
+            strand = -1
         elif r.strand == '+':
-            strand = '1'
-        key = '\t'.join([str(e) for e in exonIds]) + '\t' + strand + '\t' + str(r.NH)
+            strand = 1
+        key = tuple(exonIds) + (strand, r.NH)
 
         if not key in partitions:
             covLength = 0
@@ -1182,41 +1298,59 @@ class Alignments:
         # Index of first and last reads in array that have not been used yet
         read_bounds = [0, len(read_counts)]
 
+        # Indices of the unique reads ending at each position, and the range of unique reads starting at each position, so that mates are looked up by fragment length rather than by scanning all reads
+        ends_index = dict()
+        starts_index = dict()
+        for i in range(len(unique_reads)):
+            r = unique_reads[i]
+            if r[1] in ends_index:
+                ends_index[r[1]].append(i)
+            else:
+                ends_index[r[1]] = [i]
+            if r[0] in starts_index:
+                starts_index[r[0]][1] = i+1
+            else:
+                starts_index[r[0]] = [i, i+1]
+
         paired = []
-        unmatched = []
-        unmatched_counts = []
+        unmatched = dict()
         while countPairs > 0 and read_bounds[0] < read_bounds[1]:
-            p = self.findLeftPairRandom(unique_reads, paired_lens, read_counts, read_bounds)
+            p = self.findLeftPairRandom(unique_reads, paired_lens, read_counts, read_bounds, ends_index)
             if len(p) == 2:
                 paired.append([unique_reads[p[0]][:], unique_reads[p[1]][:]])
                 countPairs -= 1
             else:
-                self.add_to_unmatched(unmatched, unmatched_counts, unique_reads[p[0]], 1)
+                self.add_to_unmatched(unmatched, unique_reads[p[0]], 1)
 
             if countPairs == 0 or read_bounds[0] >= read_bounds[1]:
                 break
 
-            p = self.findRightPairRandom(unique_reads, paired_lens, read_counts, read_bounds)
+            p = self.findRightPairRandom(unique_reads, paired_lens, read_counts, read_bounds, starts_index)
             if debug:
                 print(p)
             if len(p) == 2:
                 paired.append([unique_reads[p[0]][:], unique_reads[p[1]][:]])
                 countPairs -= 1
             else:
-                self.add_to_unmatched(unmatched, unmatched_counts, unique_reads[p[0]], 1)
+                self.add_to_unmatched(unmatched, unique_reads[p[0]], 1)
 
         # Add remaining reads to unmatched
         for i in range(read_bounds[0], read_bounds[1]):
             if read_counts[i] > 0:
-                self.add_to_unmatched(unmatched, unmatched_counts, unique_reads[i], read_counts[i])
+                self.add_to_unmatched(unmatched, unique_reads[i], read_counts[i])
+
+        # Unique unmatched reads in sorted order, with their counts
+        unmatched_counts = [unmatched[r] for r in sorted(unmatched)]
+        unmatched = [list(r) for r in sorted(unmatched)]
 
         num_remaining = sum(unmatched_counts)
         bounds = [0, len(unmatched)]
 
         paired_lens_sorted = sorted(paired_lens)
+        unmatched_index = ReadsByEnd(unmatched, unmatched_counts)
 
         while countPairs > 0 and num_remaining > 1:
-            p = self.findClosestLeftPair(unmatched, unmatched_counts, bounds, paired_lens_sorted)
+            p = self.findClosestLeftPair(unmatched, unmatched_counts, bounds, paired_lens_sorted, unmatched_index)
             paired.append(p)
             countPairs -= 1
             num_remaining -= 2
@@ -1224,7 +1358,7 @@ class Alignments:
             if countPairs == 0 or num_remaining < 2:
                 break
 
-            p = self.findClosestRightPair(unmatched, unmatched_counts, bounds, paired_lens_sorted)
+            p = self.findClosestRightPair(unmatched, unmatched_counts, bounds, paired_lens_sorted, unmatched_index)
             paired.append(p)
             countPairs -= 1
             num_remaining -= 2
@@ -1239,23 +1373,43 @@ class Alignments:
         #print('Done!')
         return unpaired, paired
 
-    def add_to_unmatched(self, unmatched, counts, read, num):
-        i = bisect.bisect_left(unmatched, read)
-        if i < len(unmatched) and unmatched[i] == read:
-            counts[i] += num
-        else:
-            unmatched.insert(i, read)
-            counts.insert(i, num)
+    def add_to_unmatched(self, unmatched, read, num):
+        ''' Add num copies of a read to the counts of unmatched reads, which are sorted once all have been added
+        '''
 
+        r = (read[0], read[1])
+        unmatched[r] = unmatched.get(r, 0) + num
+
+
+    def findLeftPairRandom(self, reads, paired_lens, read_counts, read_bounds, ends_index=None):
+        '''
+        Pair the first remaining read with the last remaining read whose fragment length with it is in paired_lens.
+        If ends_index maps each end position to the indices of the reads ending there, candidates are looked up for each fragment length rather than scanned.
+        This requires all reads outside read_bounds to have a count of 0
+        '''
 
-    def findLeftPairRandom(self, reads, paired_lens, read_counts, read_bounds):
         i = read_bounds[0]
         read_counts[i] -= 1
 
         while read_bounds[0] < read_bounds[1] and read_counts[read_bounds[0]] == 0:
             read_bounds[0] += 1
 
-        for j in range(read_bounds[1]-1, read_bounds[0]-1, -1):
+        if ends_index == None:
+            candidates = range(read_bounds[1]-1, read_bounds[0]-1, -1)
+        else:
+            start = reads[i][0]
+            match = -1
+            for l in paired_lens:
+                ids = ends_index.get(start + l)
+                if ids:
+                    # Reads whose count has reached 0 are never used again
+                    while ids and read_counts[ids[-1]] == 0:
+                        ids.pop()
+                    if ids and ids[-1] > match:
+                        match = ids[-1]
+            candidates = [match] if match >= 0 else []
+
+        for j in candidates:
             if read_counts[j] == 0:
                 continue
 
@@ -1274,14 +1428,35 @@ class Alignments:
                 return [i, j]
         return [i]
 
-    def findRightPairRandom(self, reads, paired_lens, read_counts, read_bounds):
+    def findRightPairRandom(self, reads, paired_lens, read_counts, read_bounds, starts_index=None):
+        '''
+        Pair the last remaining read with the first remaining read whose fragment length with it is in paired_lens.
+        If starts_index maps each start position to the range of reads starting there, candidates are looked up for each fragment length rather than scanned.
+        This requires all reads outside read_bounds to have a count of 0
+        '''
+
         j = read_bounds[1]-1
         read_counts[j] -= 1
 
         while read_bounds[1] > read_bounds[0] and read_counts[read_bounds[1]-1] == 0:
             read_bounds[1] -= 1
 
-        for i in range(read_bounds[0], read_bounds[1]):
+        if starts_index == None:
+            candidates = range(read_bounds[0], read_bounds[1])
+        else:
+            end = reads[j][1]
+            match = None
+            for l in paired_lens:
+                ids = starts_index.get(end - l)
+                if ids:
+                    # Reads whose count has reached 0 are never used again
+                    while ids[0] < ids[1] and read_counts[ids[0]] == 0:
+                        ids[0] += 1
+                    if ids[0] < ids[1] and (match == None or ids[0] < match):
+                        match = ids[0]
+            candidates = [match] if not match == None else []
+
+        for i in candidates:
             if read_counts[i] == 0:
                 continue
 
@@ -1300,13 +1475,34 @@ class Alignments:
                 return [i,j]
         return [j]
 
-    def findClosestLeftPair(self, reads, counts, bounds, paired_lens_sorted):
+    def findClosestLeftPair(self, reads, counts, bounds, paired_lens_sorted, index=None):
+        '''
+        Pair the first remaining read with the first remaining read whose fragment length with it is closest to a length in paired_lens_sorted.
+        If index is a ReadsByEnd for reads, the closest lengths are found by searching around each fragment length rather than by scanning all reads
+        '''
+
         i = bounds[0]
         start = reads[i][0]
         counts[i] -= 1
         while bounds[0] < bounds[1] and counts[bounds[0]] == 0:
             bounds[0] += 1
 
+        if not index == None:
+            closestJ = None
+            closestD = None
+            for l in paired_lens_sorted:
+                d = index.nearest(start + l)
+                if not d == None and (closestD == None or d < closestD):
+                    closestD = d
+
+            if not closestD == None:
+                for l in paired_lens_sorted:
+                    for end in (start + l - closestD, start + l + closestD):
+                        j = index.first(end)
+                        if not j == None and (closestJ == None or j < closestJ):
+                            closestJ = j
+            return self.finishClosestPair(reads, counts, bounds, i, closestJ, closestJ)
+
         num_lens = len(paired_lens_sorted)
 
         # Distance to closest match
@@ -1339,26 +1535,36 @@ class Alignments:
                     closestJ = j
                     closestL = paired_lens_sorted[id-1]
 
-        if closestD == None:
-            print('Error! Trying to pair only 1 read?')
-            exit()
-
-        pair = [reads[i][:], reads[closestJ][:]]
-        counts[closestJ] -= 1
-        while bounds[0] < bounds[1] and counts[bounds[0]] == 0:
-            bounds[0] += 1
-        while bounds[0] < bounds[1] and counts[bounds[1]-1] == 0:
-            bounds[1] -= 1
+        return self.finishClosestPair(reads, counts, bounds, i, closestJ, closestJ)
 
-        return pair
+    def findClosestRightPair(self, reads, counts, bounds, paired_lens_sorted, index=None):
+        '''
+        Pair the last remaining read with the last remaining read whose distance between ends is closest to a length in paired_lens_sorted.
+        If index is a ReadsByEnd for reads, the closest lengths are found by searching around each fragment length rather than by scanning all reads
+        '''
 
-    def findClosestRightPair(self, reads, counts, bounds, paired_lens_sorted):
         j = bounds[1]-1
         end = reads[j][1]
         counts[j] -= 1
         while bounds[0] < bounds[1] and counts[bounds[1]-1] == 0:
             bounds[1] -= 1
 
+        if not index == None:
+            closestI = None
+            closestD = None
+            for l in paired_lens_sorted:
+                d = index.nearest(end - l)
+                if not d == None and (closestD == None or d < closestD):
+                    closestD = d
+
+            if not closestD == None:
+                for l in paired_lens_sorted:
+                    for e in (end - l - closestD, end - l + closestD):
+                        i = index.last(e)
+                        if not i == None and (closestI == None or i > closestI):
+                            closestI = i
+            return self.finishClosestPair(reads, counts, bounds, closestI, j, closestI)
+
         num_lens = len(paired_lens_sorted)
 
         # Distance to closest match
@@ -1391,13 +1597,19 @@ class Alignments:
                     closestI = i
                     closestL = paired_lens_sorted[id-1]
 
+        return self.finishClosestPair(reads, counts, bounds, closestI, j, closestI)
 
-        if closestD == None:
+    def finishClosestPair(self, reads, counts, bounds, i, j, match):
+        '''
+        Return the pair of reads i and j found by findClosestLeftPair() or findClosestRightPair(), using up the matched read
+        '''
+
+        if match == None:
             print('Error! Trying to pair only 1 read?')
             exit()
 
-        pair = [reads[closestI][:], reads[j][:]]
-        counts[closestI] -= 1
+        pair = [reads[i][:], reads[j][:]]
+        counts[match] -= 1
         while bounds[0] < bounds[1] and counts[bounds[0]] == 0:
             bounds[0] += 1
         while bounds[0] < bounds[1] and counts[bounds[1]-1] == 0:
@@ -1960,19 +2172,33 @@ class Alignments:
         return r
 
     def findNextGap(self, cov, start, end, modeLen):
-        gap = False
-        for i in range(min(modeLen,end-start)):
-            if cov[start+i] > 0:
-                if gap:
-                    return [gap_start, i]
-            else:
-                if not gap:
-                    gap_start = i
-                    gap = True
-        if gap:
-            return [gap_start, i+1]
-        else:
+        ''' Find the first run of uncovered bases within modeLen bases of start.
+            Returns the offsets from start of the beginning and end of the run, or None if there is none
+        '''
+
+        n = min(modeLen, end-start)
+        if n <= 0:
             return None
+        window = cov[start:start+n]
+
+        # Most windows are fully covered, which min() checks without a Python-level loop
+        if min(window) > 0:
+            return None
+
+        gap_start = 0
+        while window[gap_start] > 0:
+            gap_start += 1
+        for i in range(gap_start+1, n):
+            if window[i] > 0:
+                return [gap_start, i]
+        return [gap_start, n]
+
+    def addCov(self, cov, start, end, val):
+        ''' Add val to each base of cov in [start, end)
+        '''
+
+        if start < end:
+            cov[start:end] = [c + val for c in cov[start:end]]
 
     def extendReadRight(self, cov, start, stop, reads, max_len, num_reads):
         '''
@@ -2006,8 +2232,7 @@ class Alignments:
                 if i < new_pos:
                     self.move_read(reads, i, new_pos)
 
-                for i in range(start, r[1]):
-                    cov[i] -= 1
+                self.addCov(cov, start, r[1], -1)
 
                 return True
         return False
@@ -2031,8 +2256,7 @@ class Alignments:
                         new_pos = j+1
                         break
 
-                for n in range(start, r[1]):
-                    cov[n] += 1
+                self.addCov(cov, start, r[1], 1)
                 r[1] = start
 
                 self.move_read(reads, i, new_pos)
@@ -2045,26 +2269,23 @@ class Alignments:
             reads.append([new_read[0], new_read[1], 1])
             return 1
 
-        # After adding new read, this should be its position in the array
-        new_pos = -1
-        for i in range(num_reads-1, -1, -1):
-            if reads[i][1] < new_read[1]:
-                new_pos = i
-                break
+        # Reads are sorted by end position
+        ends = ReadEnds(reads)
 
-        for i in range(new_pos, -1, -1):
-            if reads[i][1] == new_read[0]:
-                # We can extend this read rather than adding a new one
-                reads[i][1] = new_read[1]
-                reads[i][2] += 1
+        # After adding new read, this should be its position in the array
+        new_pos = bisect.bisect_left(ends, new_read[1]) - 1
 
-                # Move read from i to j
-                if i < new_pos:
-                    self.move_read(reads, i, new_pos)
-                return num_reads
+        # Last read ending at or before the start of the new read
+        i = bisect.bisect_right(ends, new_read[0], 0, new_pos+1) - 1
+        if i >= 0 and reads[i][1] == new_read[0]:
+            # We can extend this read rather than adding a new one
+            reads[i][1] = new_read[1]
+            reads[i][2] += 1
 
-            elif reads[i][1] < new_read[0]:
-                break
+            # Move read from i to j
+            if i < new_pos:
+                self.move_read(reads, i, new_pos)
+            return num_reads
 
         # We have to add a new read
         r = [new_read[0], new_read[1], 1]
@@ -2077,15 +2298,11 @@ class Alignments:
         return num_reads+1
 
     def move_read(self, reads, i, j):
-        r = reads[i]
-        if i < j:
-            for x in range(i, j):
-                reads[x] = reads[x+1]
-            reads[j] = r
-        elif i > j:
-            for x in range(i, j, -1):
-                reads[x] = reads[x-1]
-            reads[j] = r
+        ''' Move the read at index i to index j, shifting the reads in between
+        '''
+
+        if not i == j:
+            reads.insert(j, reads.pop(i))
 
     def findReadLeft(self, cov, start, end, reads, min_len, max_len, mode_len, num_reads):
         gap = self.findNextGap(cov, start, end, mode_len)
@@ -2099,13 +2316,11 @@ class Alignments:
                 if not self.extendReadRight(cov, start, readEnd, reads, max_len, num_reads):
                     # We want to make sure that coverage ends at the right place
                     num_reads = self.add_read(reads, [readEnd - min_len, readEnd], num_reads)
-                    for i in range(start, readEnd):
-                        cov[i] -= 1
+                    self.addCov(cov, start, readEnd, -1)
             else:
                 #print('Adding read [%d, %d]' % (start, readEnd))
                 num_reads = self.add_read(reads, [start, readEnd], num_reads)
-                for i in range(start, readEnd):
-                    cov[i] -= 1
+                self.addCov(cov, start, readEnd, -1)
         else:
             r = self.extendReadRight(cov, start, start+gap[0], reads, max_len, num_reads)
             if not r:
@@ -2122,8 +2337,7 @@ class Alignments:
                     readEnd = min(start+mode_len, end)
                     num_reads = self.add_read(reads, [start, readEnd], num_reads)
 
-                for i in range(start, readEnd):
-                    cov[i] -= 1
+                self.addCov(cov, start, readEnd, -1)
 
         while start < end and cov[start] <= 0:
             start += 1
@@ -2143,136 +2357,194 @@ class Alignments:
                 index -= self.chromosomes[c]
 
     def writeSAM(self, filehandle, unpaired, paired, header=True, force_xs=False, readId=0):
-        ''' Write all alignments to a SAM file
+        ''' Write all alignments to a SAM file.
+            The records are formatted into a single buffer, which is written to filehandle at once
         '''
 
+        lines, readId = self.formatSAM(unpaired, paired, force_xs, readId)
+
         # write header
         if header:
-            filehandle.write('@HD\tVN:1.0\tSO:unsorted\n')
-            for c in self.chromosomeNames:
-                filehandle.write('@SQ\tSN:' + str(c) + '\tLN:' + str(self.chromosomes[c]) + '\n')
+            lines.insert(0, self.headerText())
+
+        filehandle.write(''.join(lines))
+
+        return readId
+
+    def formatSAM(self, unpaired, paired, force_xs=False, readId=0, starts=None):
+        ''' Format all alignments as SAM lines. Returns the list of lines and the id following the last read.
+            If starts is a list, the genome position of each line is appended to it
+        '''
+
+        records, readId = self.buildRecords(unpaired, paired, samIO.exonsToCigar, force_xs, readId, starts)
+
+        lines = []
+
+        chromOffsets = self.chromOffsets
+
+        for name, flag, chrom, exons, cigar, mateChrom, mateStart, tlen, strand, NH in records:
+            offset = chromOffsets[chrom]
+
+            if mateChrom == None:
+                if strand:
+                    tags = '\tXS:A:%s\tNH:i:%d\n' % (strand, NH)
+                else:
+                    tags = '\tNH:i:%d\n' % NH
+                lines.append('%s\t%d\t%s\t%d\t50\t%s\t*\t0\t0\t*\t*%s' % (name, flag, chrom, exons[0][0]-offset, cigar[0], tags))
+                continue
+
+            if strand:
+                tags = '\tNH:i:%d\tXS:A:%s\n' % (NH, strand)
+            else:
+                tags = '\tNH:i:%d\n' % NH
+
+            if mateChrom == chrom:
+                lines.append('%s\t%d\t%s\t%d\t50\t%s\t=\t%d\t%d\t*\t*%s' % (name, flag, chrom, exons[0][0]-offset, cigar[0], mateStart-offset, tlen, tags))
+            else:
+                lines.append('%s\t%d\t%s\t%d\t50\t%s\t%s\t%d\t%d\t*\t*%s' % (name, flag, chrom, exons[0][0]-offset, cigar[0], mateChrom, mateStart-chromOffsets[mateChrom], tlen, tags))
+
+        return lines, readId
+
+    def buildRecords(self, unpaired, paired, exonsToCigar, force_xs=False, readId=0, starts=None):
+        ''' Collect the fields shared by the SAM and BAM records of all valid alignments, in output order.
+            Returns a list of (name, flag, chrom, exons, cigar, mateChrom, mateStart, tlen, strand, NH) tuples, one per record, and the id following the last read.
+            mateChrom and mateStart (a genome position) are None for unpaired reads.
+
+            exonsToCigar: samIO.exonsToCigar() or bamIO.exonsToCigar(), whose result is stored as the cigar and ends with True if the read is spliced
+            force_xs: If True, spliced reads with no XS value are assigned a random one
+            starts: If a list, the genome position of each record is appended to it
+        '''
+
+        records = []
 
         for read in unpaired:
+            exons = read.exons
             invalid = False
-            for i in range(len(read.exons)-1):
-                if read.exons[i+1][0] < read.exons[i][1]:
+            for i in range(len(exons)-1):
+                if exons[i+1][0] < exons[i][1]:
                     invalid = True
                     break
             if invalid:
                 continue
 
-            exons = read.exons
-            cigar = [str(exons[0][1] - exons[0][0]) + 'M']
-            spliced = False
-            for i in range(1, len(exons)):
-                if exons[i][0] == exons[i-1][1]:
-                    prevLen = int(cigar[-1][:-1])
-                    cigar[-1] = str(prevLen + exons[i][1] - exons[i][0]) + 'M'
-                else:
-                    spliced = True
-                    cigar += [str(exons[i][0] - exons[i-1][1]) + 'N']
-                    cigar += [str(exons[i][1] - exons[i][0]) + 'M']
-            cigar = ''.join(cigar)
-
-            chrom = read.chrom
-            offset = self.chromOffsets[chrom]
+            cigar = exonsToCigar(exons)
 
-            if force_xs and spliced and not read.strand:
+            if force_xs and cigar[-1] and not read.strand:
                 #print('Assigning random XS value to spliced unpaired read')
                 if random.randint(0,1) == 0:
                     read.strand = '+'
                 else:
                     read.strand = '-'
 
-            if read.strand:
-                filehandle.write(chrom+':'+str(readId) + '\t0\t' + chrom + '\t' + str(exons[0][0]-offset) + '\t50\t' + cigar + '\t*\t0\t0\t*\t*\tXS:A:' + read.strand + '\tNH:i:' + str(int(read.NH)) + '\n')
-            else:
-                filehandle.write(chrom+':'+str(readId) + '\t0\t' + chrom + '\t' + str(exons[0][0]-offset) + '\t50\t' + cigar + '\t*\t0\t0\t*\t*\tNH:i:' + str(int(read.NH)) + '\n')
+            if not starts == None:
+                starts.append(exons[0][0])
+
+            chrom = read.chrom
+            records.append(('%s:%d' % (chrom, readId), 0, chrom, exons, cigar, None, None, 0, read.strand, read.NH))
             readId += 1
-        
+
         for pair in paired:
+            exonsA = pair.exonsA
+            exonsB = pair.exonsB
             invalid = False
-            for i in range(len(pair.exonsA)-1):
-                if pair.exonsA[i+1][0] < pair.exonsA[i][1]:
+            for i in range(len(exonsA)-1):
+                if exonsA[i+1][0] < exonsA[i][1]:
                     invalid = True
                     break
             if invalid:
                 continue
-            for i in range(len(pair.exonsB)-1):
-                if pair.exonsB[i+1][0] < pair.exonsB[i][1]:
+            for i in range(len(exonsB)-1):
+                if exonsB[i+1][0] < exonsB[i][1]:
                     invalid = True
                     break
             if invalid:
                 continue
 
-            exonsA = pair.exonsA
-            cigarA = [str(exonsA[0][1] - exonsA[0][0]) + 'M']
-            spliced = False
-            for i in range(1, len(exonsA)):
-                if exonsA[i][0] == exonsA[i-1][1]:
-                    prevLen = int(cigarA[-1][:-1])
-                    cigarA[-1] = str(prevLen + exonsA[i][1] - exonsA[i][0]) + 'M'
-                else:
-                    spliced = True
-                    cigarA += [str(exonsA[i][0] - exonsA[i-1][1]) + 'N']
-                    cigarA += [str(exonsA[i][1] - exonsA[i][0]) + 'M']
-            cigarA = ''.join(cigarA)
-
-            exonsB = pair.exonsB
-            cigarB = [str(exonsB[0][1] - exonsB[0][0]) + 'M']
-            for i in range(1, len(exonsB)):
-                if exonsB[i][0] == exonsB[i-1][1]:
-                    prevLen = int(cigarB[-1][:-1])
-                    cigarB[-1] = str(prevLen + exonsB[i][1] - exonsB[i][0]) + 'M'
-                else:
-                    spliced = True
-                    cigarB += [str(exonsB[i][0] - exonsB[i-1][1]) + 'N']
-                    cigarB += [str(exonsB[i][1] - exonsB[i][0]) + 'M']
-            cigarB = ''.join(cigarB)
-
-            # Distance from start of first read to end of second read
-            totalLen = max(exonsA[-1][1],exonsB[-1][1]) - exonsA[0][0]
+            cigarA = exonsToCigar(exonsA)
+            cigarB = exonsToCigar(exonsB)
 
             chromA = pair.chromA
             chromB = pair.chromB
-            offsetA = self.chromOffsets[chromA]
-            if not chromA == chromB:
-                offsetB = self.chromOffsets[chromB]
+            if chromA == chromB:
+                # Distance from start of first read to end of second read
+                totalLen = max(exonsA[-1][1],exonsB[-1][1]) - exonsA[0][0]
+            else:
+                totalLen = 0
 
-            if force_xs and spliced and not pair.strand:
+            if force_xs and (cigarA[-1] or cigarB[-1]) and not pair.strand:
                 #print('Assigning random XS value to spliced paired read')
                 if random.randint(0,1) == 0:
                     pair.strand = '+'
                 else:
                     pair.strand = '-'
 
-            #if chromA == chromB and self.conflicts(exonsA, exonsB):
-            #    if pair.strand:
-            #        filehandle.write(chromA+':'+str(readId) + '\t0\t' + chromA + '\t' + str(exonsA[0][0]-offsetA) + '\t50\t' + cigarA + '\t*\t0\t0\t*\t*\tNH:i:' + str(pair.NH) + '\tXS:A:' + pair.strand + '\n')
-            #        readId += 1
-            #        filehandle.write(chromB+':'+str(readId) + '\t0\t' + chromB + '\t' + str(exonsB[0][0]-offsetA) + '\t50\t' + cigarB + '\t*\t0\t0\t*\t*\tNH:i:' + str(pair.NH) + '\tXS:A:' + pair.strand + '\n')
-            #    else:
-            #        filehandle.write(chromA+':'+str(readId) + '\t0\t' + chromA + '\t' + str(exonsA[0][0]-offsetA) + '\t50\t' + cigarA + '\t*\t0\t0\t*\t*\tNH:i:' + str(pair.NH) + '\n')
-            #        readId += 1
-            #        filehandle.write(chromB+':'+str(readId) + '\t0\t' + chromB + '\t' + str(exonsB[0][0]-offsetA) + '\t50\t' + cigarB + '\t*\t0\t0\t*\t*\tNH:i:' + str(pair.NH) + '\n')
-            #else:
-            if chromB == chromA:
-                filehandle.write(chromA+':'+str(readId) + '\t81\t' + chromA + '\t' + str(exonsA[0][0]-offsetA) + '\t50\t' + cigarA + '\t=\t' + str(exonsB[0][0]-offsetA) + '\t' + str(totalLen) + '\t*\t*\tNH:i:' + str(int(pair.NH)))
-            else:
-                filehandle.write(chromA+':'+str(readId) + '\t81\t' + chromA + '\t' + str(exonsA[0][0]-offsetA) + '\t50\t' + cigarA + '\t' + chromB + '\t' + str(exonsB[0][0]-offsetB) + '\t0\t*\t*\tNH:i:' + str(int(pair.NH)))
+            if not starts == None:
+                starts.append(exonsA[0][0])
+                starts.append(exonsB[0][0])
 
-            if pair.strand:# and 'N' in cigarA:
-                filehandle.write('\tXS:A:' + pair.strand)
-            filehandle.write('\n')
-
-            if chromB == chromA:
-                filehandle.write(chromA+':'+str(readId) + '\t161\t' + chromB + '\t' + str(exonsB[0][0]-offsetA) + '\t50\t' + cigarB + '\t=\t' + str(exonsA[0][0]-offsetA) + '\t' + str(-totalLen) + '\t*\t*\tNH:i:' + str(int(pair.NH)))
-            else:
-                filehandle.write(chromA+':'+str(readId) + '\t161\t' + chromB + '\t' + str(exonsB[0][0]-offsetB) + '\t50\t' + cigarB + '\t' + chromA + '\t' + str(exonsA[0][0]-offsetA) + '\t0\t*\t*\tNH:i:' + str(int(pair.NH)))
-            if pair.strand:# and 'N' in cigarB:
-                filehandle.write('\tXS:A:' + pair.strand)
-            filehandle.write('\n')
+            name = '%s:%d' % (chromA, readId)
+            records.append((name, 81, chromA, exonsA, cigarA, chromB, exonsB[0][0], totalLen, pair.strand, pair.NH))
+            records.append((name, 161, chromB, exonsB, cigarB, chromA, exonsA[0][0], -totalLen, pair.strand, pair.NH))
 
             readId += 1
 
+        return records, readId
+
+    def headerText(self, sort=False):
+        ''' Return the header of the SAM or BAM file for these alignments. If sort is True, the header marks the file as sorted by coordinate
+        '''
+
+        if sort:
+            lines = ['@HD\tVN:1.0\tSO:coordinate\n']
+        else:
+            lines = ['@HD\tVN:1.0\tSO:unsorted\n']
+        for c in self.chromosomeNames:
+            lines.append('@SQ\tSN:' + str(c) + '\tLN:' + str(self.chromosomes[c]) + '\n')
+        return ''.join(lines)
+
+    def headerBAM(self, sort=False):
+        ''' Return the encoded header of the BAM file for these alignments
+        '''
+
+        return bamIO.encodeHeader(self.headerText(sort), self.chromosomeNames, [self.chromosomes[c] for c in self.chromosomeNames])
+
+    def writeBAM(self, writer, unpaired, paired, header=True, force_xs=False, readId=0):
+        ''' Write all alignments as BAM records, with the same names, fields and order as writeSAM()
+
+            writer: bamIO.BGZFWriter for the output file
+        '''
+
+        records, readId = self.formatBAM(unpaired, paired, force_xs, readId)
+
+        if header:
+            records.insert(0, self.headerBAM())
+
+        writer.write(b''.join(records))
+
         return readId
+
+    def formatBAM(self, unpaired, paired, force_xs=False, readId=0, starts=None):
+        ''' Encode all alignments as BAM records. Returns the list of records and the id following the last read.
+            If starts is a list, the genome position of each record is appended to it
+        '''
+
+        fields, readId = self.buildRecords(unpaired, paired, bamIO.exonsToCigar, force_xs, readId, starts)
+
+        records = []
+
+        refIDs = dict()
+        for i in range(len(self.chromosomeNames)):
+            refIDs[self.chromosomeNames[i]] = i
+
+        chromOffsets = self.chromOffsets
+
+        for name, flag, chrom, exons, cigar, mateChrom, mateStart, tlen, strand, NH in fields:
+            # Positions are 0-based in BAM
+            offset = chromOffsets[chrom] + 1
+
+            if mateChrom == None:
+                records.append(bamIO.encodeRecord(name, flag, refIDs[chrom], exons[0][0]-offset, cigar, exons[-1][1]-offset, -1, -1, 0, bamIO.encodeTags(strand, int(NH), True)))
+            else:
+                records.append(bamIO.encodeRecord(name, flag, refIDs[chrom], exons[0][0]-offset, cigar, exons[-1][1]-offset, refIDs[mateChrom], mateStart-chromOffsets[mateChrom]-1, tlen, bamIO.encodeTags(strand, int(NH), False)))
+
+        return records, readId
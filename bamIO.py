@@ -0,0 +1,369 @@
+import zlib
+import samIO
+from struct import *
+
+# Magic bytes at the start of every BGZF block (gzip header with the FEXTRA flag set)
+bgzfMagic = b'\x1f\x8b\x08\x04'
+
+# Magic bytes at the start of the decompressed BAM stream
+bamMagic = b'BAM\x01'
+
+# Fixed-length portion of each alignment record, following block_size
+recordFormat = Struct('<iiBBHHHiiii')
+
+# Empty BGZF block marking the end of a BAM file
+bgzfEOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+# Maximum amount of uncompressed data in each BGZF block written
+maxBlockData = 0xff00
+
+# Binary cigar string of each exon layout seen so far, relative to the start of the read, with its number of operations and whether it is spliced
+layoutCache = dict()
+
+# Codes of cigar operations in binary cigar strings
+cigarCodes = {'M': 0, 'N': 3}
+
+def isBAM(f):
+    ''' Return True if the given binary file begins with a BGZF block.
+        The file must support peek() so that no data is consumed.
+    '''
+
+    return f.peek(4)[:4] == bgzfMagic
+
+class BGZFReader:
+    ''' Sequentially decompress the blocks of a BGZF file '''
+
+    def __init__(self, f):
+        self.f = f
+
+        # Decompressed data that has not been consumed yet
+        self.buffer = b''
+        self.pos = 0
+
+    def readBlock(self):
+        ''' Decompress the next BGZF block. Returns None at the end of the file
+        '''
+
+        header = self.f.read(12)
+        if len(header) < 12:
+            return None
+        if not header[:4] == bgzfMagic:
+            print('Error! Input is not a valid BGZF file')
+            exit()
+
+        # Find the total block size in the BC subfield of the extra field
+        xlen = unpack_from('<H', header, 10)[0]
+        extra = self.f.read(xlen)
+        blockSize = None
+        i = 0
+        while i < xlen:
+            slen = unpack_from('<H', extra, i+2)[0]
+            if extra[i:i+2] == b'BC':
+                blockSize = unpack_from('<H', extra, i+4)[0] + 1
+            i += 4 + slen
+        if blockSize == None:
+            print('Error! BGZF block is missing its size field')
+            exit()
+
+        # Compressed data is followed by the CRC32 and uncompressed size
+        data = self.f.read(blockSize - 12 - xlen)
+        return zlib.decompress(data[:-8], -15)
+
+    def read(self, n):
+        ''' Return the next n bytes of decompressed data
+        '''
+
+        self.fill(n)
+        s = self.buffer[self.pos:self.pos+n]
+        self.pos += len(s)
+        return s
+
+    def fill(self, n):
+        ''' Make sure at least n bytes are available in the buffer starting at self.pos, if the file is long enough.
+            Returns the number of bytes available
+        '''
+
+        while len(self.buffer) - self.pos < n:
+            block = self.readBlock()
+            if block == None:
+                break
+            self.buffer = self.buffer[self.pos:] + block
+            self.pos = 0
+        return len(self.buffer) - self.pos
+
+def readHeader(reader):
+    ''' Read the header of a BAM file
+
+        :param reader: BGZFReader positioned at the start of the file
+        :return: The header text and a list containing the list of chromosome names and the list of chromosome lengths, in the same form as Compressor.parseSAMHeader()
+    '''
+
+    if not reader.read(4) == bamMagic:
+        print('Error! Input is not a valid BAM file')
+        exit()
+
+    l_text = unpack('<i', reader.read(4))[0]
+    text = reader.read(l_text).rstrip(b'\0').decode('ascii')
+
+    n_ref = unpack('<i', reader.read(4))[0]
+    names = [None] * n_ref
+    lens = [0] * n_ref
+    for i in range(n_ref):
+        l_name = unpack('<i', reader.read(4))[0]
+        names[i] = reader.read(l_name)[:-1].decode('ascii')
+        lens[i] = unpack('<i', reader.read(4))[0]
+
+    return text, [names, lens]
+
+def readAlignments(reader, chromNames):
+    ''' Decode the alignment records in a BAM file, following the header
+
+        :param reader: BGZFReader positioned after the header
+        :param chromNames: List of chromosome names in the order they appear in the header
+        :return: Generator over alignments in the same form as Compressor.parseSAMAlignments()
+    '''
+
+    unpack_record = recordFormat.unpack_from
+
+    while reader.fill(4) >= 4:
+        block_size = unpack_from('<i', reader.buffer, reader.pos)[0]
+        if reader.fill(4 + block_size) < 4 + block_size:
+            print('Error! BAM file is truncated')
+            exit()
+
+        s = reader.buffer
+        start = reader.pos + 4
+        reader.pos = start + block_size
+
+        refID, pos, l_read_name, _, _, n_cigar_op, flags, l_seq, next_refID, next_pos, _ = unpack_record(s, start)
+
+        i = start + 32
+        name = s[i:i+l_read_name-1].decode('ascii')
+        i += l_read_name
+
+        # Positions are 0-based in BAM and 1-based in SAM
+        pos += 1
+        if refID < 0:
+            chrom = '*'
+        else:
+            chrom = chromNames[refID]
+
+        if next_refID < 0:
+            mate_chrom = '*'
+        elif next_refID == refID:
+            mate_chrom = '='
+        else:
+            mate_chrom = chromNames[next_refID]
+        mate_pos = next_pos + 1
+
+        if n_cigar_op == 0:
+            exons = None
+        else:
+            exons = cigarToExons(unpack_from('<%dI' % n_cigar_op, s, i), pos)
+        i += 4 * n_cigar_op
+
+        # Skip sequence and quality strings
+        i += (l_seq + 1) // 2 + l_seq
+
+        strand, NH = readTags(s, i, reader.pos)
+
+        yield name, flags, chrom, pos, exons, strand, NH, mate_chrom, mate_pos
+
+def cigarToExons(cigar, offset):
+    ''' Convert binary CIGAR operations to a list of exons, in the same form as samIO.parseCigar()
+    '''
+
+    exons = []
+    newExon = True
+
+    for c in cigar:
+        length = c >> 4
+        op = c & 15
+
+        if op == 3:
+            # N: Separates contiguous exons, so set boolean to start a new one
+            newExon = True
+        elif op == 0:
+            # M: If in the middle of a contiguous exon, append the length to it, otherwise start a new exon
+            if newExon:
+                exons.append([offset, offset+length])
+                newExon = False
+            else:
+                exons[-1][1] += length
+        elif op == 2:
+            # D: If in the middle of a contiguous exon, append the deleted length to it
+            if not newExon:
+                exons[-1][1] += length
+
+        # Skip soft clipping
+        if not op == 4:
+            offset += length
+
+    return exons
+
+# Size in bytes of each fixed-width auxiliary value type
+tagSizes = {b'A': 1, b'c': 1, b'C': 1, b's': 2, b'S': 2, b'i': 4, b'I': 4, b'f': 4}
+
+# Struct formats for integer auxiliary values
+tagFormats = {b'c': '<b', b'C': '<B', b's': '<h', b'S': '<H', b'i': '<i', b'I': '<I'}
+
+def readTags(s, start, end):
+    ''' Find the XS and NH values among the auxiliary fields of an alignment record
+
+        :return: XS value (or None) and NH value (default 1)
+    '''
+
+    strand = None
+    NH = 1
+
+    i = start
+    while i < end:
+        tag = s[i:i+2]
+        t = s[i+2:i+3]
+        i += 3
+
+        if t in tagSizes:
+            if tag == b'XS' and t == b'A':
+                strand = chr(s[i])
+            elif tag == b'NH' and t in tagFormats:
+                NH = unpack_from(tagFormats[t], s, i)[0]
+            i += tagSizes[t]
+        elif t == b'Z' or t == b'H':
+            i = s.index(b'\0', i) + 1
+        elif t == b'B':
+            subtype = s[i:i+1]
+            count = unpack_from('<i', s, i+1)[0]
+            i += 5 + count * tagSizes[subtype]
+        else:
+            break
+
+    return strand, NH
+
+class BGZFWriter:
+    ''' Compress data into a sequence of BGZF blocks '''
+
+    def __init__(self, f, level=6):
+        self.f = f
+        self.level = level
+
+        # Data that has not been compressed yet
+        self.buffer = []
+        self.bufferLen = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.bufferLen += len(data)
+
+        if self.bufferLen >= maxBlockData:
+            data = b''.join(self.buffer)
+            start = 0
+            while len(data) - start >= maxBlockData:
+                self.writeBlock(data[start:start+maxBlockData])
+                start += maxBlockData
+            self.buffer = [data[start:]]
+            self.bufferLen = len(data) - start
+
+    def writeBlock(self, data):
+        ''' Compress the given data into a single BGZF block
+        '''
+
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+        compressed = c.compress(data) + c.flush()
+
+        # The BC subfield holds the total block size minus 1
+        self.f.write(pack('<4sIBBHBBHH', bgzfMagic, 0, 0, 255, 6, 66, 67, 2, len(compressed) + 25))
+        self.f.write(compressed)
+        self.f.write(pack('<II', zlib.crc32(data) & 0xffffffff, len(data)))
+
+    def close(self):
+        ''' Compress any remaining data and write the end-of-file block. The underlying file is not closed
+        '''
+
+        if self.bufferLen > 0:
+            self.writeBlock(b''.join(self.buffer))
+        self.buffer = []
+        self.bufferLen = 0
+        self.f.write(bgzfEOF)
+
+def encodeHeader(text, names, lens):
+    ''' Encode the header of a BAM file
+
+        :param text: Header text, in the form of the header of a SAM file
+        :param names: List of chromosome names
+        :param lens: List of chromosome lengths
+    '''
+
+    text = text.encode('ascii')
+    header = [bamMagic, pack('<i', len(text)), text, pack('<i', len(names))]
+    for i in range(len(names)):
+        name = names[i].encode('ascii') + b'\0'
+        header.append(pack('<i', len(name)))
+        header.append(name)
+        header.append(pack('<i', lens[i]))
+    return b''.join(header)
+
+def exonsToCigar(exons):
+    ''' Return the binary cigar string for a read with the given exons, in the same form as samIO.exonsToCigar(), along with its number of operations and True if the read is spliced
+    '''
+
+    start = exons[0][0]
+    if len(exons) == 1:
+        layout = exons[0][1] - start
+    else:
+        layout = tuple(x - start for e in exons for x in e)
+
+    cigar = layoutCache.get(layout)
+    if cigar == None:
+        if len(layoutCache) >= samIO.maxCacheSize:
+            layoutCache.clear()
+        lengths, ops, spliced = samIO.cigarOps(exons)
+        cigar = (pack('<%dI' % len(ops), *[(lengths[i] << 4) | cigarCodes[ops[i]] for i in range(len(ops))]), len(ops), spliced)
+        layoutCache[layout] = cigar
+
+    return cigar
+
+def reg2bin(start, end):
+    ''' Return the BAI bin of an alignment covering [start, end), with 0-based positions
+    '''
+
+    end -= 1
+    if start >> 14 == end >> 14:
+        return ((1 << 15) - 1) // 7 + (start >> 14)
+    if start >> 17 == end >> 17:
+        return ((1 << 12) - 1) // 7 + (start >> 17)
+    if start >> 20 == end >> 20:
+        return ((1 << 9) - 1) // 7 + (start >> 20)
+    if start >> 23 == end >> 23:
+        return ((1 << 6) - 1) // 7 + (start >> 23)
+    if start >> 26 == end >> 26:
+        return ((1 << 3) - 1) // 7 + (start >> 26)
+    return 0
+
+def encodeTags(strand, NH, xsFirst):
+    ''' Encode the XS (if strand is not None) and NH auxiliary fields of an alignment record.
+        NH is stored in the smallest integer type that holds it, as samtools does
+    '''
+
+    if 0 <= NH < 256:
+        nh = b'NHC' + pack('<B', NH)
+    else:
+        nh = b'NHi' + pack('<i', NH)
+
+    if not strand:
+        return nh
+    elif xsFirst:
+        return b'XSA' + strand.encode('ascii') + nh
+    else:
+        return nh + b'XSA' + strand.encode('ascii')
+
+def encodeRecord(name, flag, refID, pos, cigar, end, next_refID, next_pos, tlen, tags, mapq=50):
+    ''' Encode an alignment record with no sequence or quality string
+
+        :param pos: 0-based start of the alignment
+        :param cigar: Binary cigar string and number of operations, as returned by exonsToCigar()
+        :param end: 0-based end of the alignment, exclusive
+    '''
+
+    name = name.encode('ascii')
+    record = recordFormat.pack(refID, pos, len(name)+1, mapq, reg2bin(pos, end), cigar[1], flag, 0, next_refID, next_pos, tlen) + name + b'\0' + cigar[0] + tags
+    return pack('<i', len(record)) + record
@@ -1,4 +1,6 @@
 import math
+import mmap
+import zlib
 import cross_bundle_bucket
 import time
 from struct import *
@@ -7,6 +9,19 @@ from struct import *
 formats = {1:'B', 2:'H', 4:'I', 8:'Q'}
 byteVal = int(pow(2,8))
 
+# Version of the file format written by the compressor, stored in the trailer. Readers support every version up to this one
+#   0 - Fixed-width values throughout
+#   1 - Delta-coded cluster table, and varint coverage vectors and length distributions
+#   2 - Each bundle block begins with its layout
+#   3 - Cross-bundle bucket names are stored in their chunks, and the cross-bundle index maps each bundle to the chunks that touch it
+formatVersion = 3
+
+# Layouts of a bundle block
+#   Row: a single compressed stream with the coverage and length distributions of each bucket interleaved
+#   Columnar: the bucket list and all coverage vectors in one compressed stream, followed by all length distributions in another
+layoutRow = 0
+layoutColumnar = 1
+
 def valToBinary(numBytes, val):
     ''' Convert a value to a byte string which can then be written to a file
     '''
@@ -22,23 +37,296 @@ def binaryToVal(s, numBytes, start=0):
 def writeVal(f, numBytes, val):
     f.write(valToBinary(numBytes, val))
 
+def packVals(numBytes, vals):
+    ''' Convert a list of values, each stored in numBytes bytes, to a byte string
+    '''
+
+    if numBytes in formats:
+        return pack('>%d%s' % (len(vals), formats[numBytes]), *vals)
+    return b''.join([v.to_bytes(numBytes, byteorder='big') for v in vals])
+
+def packValPairs(numBytesA, numBytesB, pairs):
+    ''' Convert a list of pairs of values to a byte string, storing the first value of each pair in numBytesA bytes and the second in numBytesB bytes
+    '''
+
+    if numBytesA in formats and numBytesB in formats:
+        packPair = Struct('>' + formats[numBytesA] + formats[numBytesB]).pack
+        return b''.join([packPair(a, b) for a, b in pairs])
+    return b''.join([a.to_bytes(numBytesA, byteorder='big') + b.to_bytes(numBytesB, byteorder='big') for a, b in pairs])
+
+class BinaryWriter:
+    ''' Accumulates encoded values in a single bytearray, so that building a long string takes linear time
+    '''
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def write(self, s):
+        self.buffer += s
+
+    def writeVal(self, numBytes, val):
+        self.buffer += val.to_bytes(numBytes, byteorder='big')
+
+    def writeVals(self, numBytes, vals):
+        self.buffer += packVals(numBytes, vals)
+
+    def writeValPairs(self, numBytesA, numBytesB, pairs):
+        self.buffer += packValPairs(numBytesA, numBytesB, pairs)
+
+    def writeVarint(self, val):
+        self.buffer += packVarints((val,))
+
+    def writeVarints(self, vals):
+        self.buffer += packVarints(vals)
+
+    def getValue(self):
+        return bytes(self.buffer)
+
+class MappedReader:
+    ''' Read-only, file-like access to a file mapped into memory.
+        read() returns memoryview slices of the mapping rather than copies, so blocks can be passed to the codecs directly,
+        and processes reading the same file share its pages in the page cache
+    '''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        self.pos = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read(self, n=-1):
+        if n < 0:
+            end = len(self.view)
+        else:
+            end = min(self.pos + n, len(self.view))
+        s = self.view[self.pos:end]
+        self.pos = end
+        return s
+
+    def readline(self):
+        end = self.map.find(b'\n', self.pos)
+        if end < 0:
+            end = len(self.view)
+        else:
+            end += 1
+        s = self.map[self.pos:end]
+        self.pos = end
+        return s
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += len(self.view)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Slices returned by read() are still in use. The mapping is released when the last of them is
+            pass
+
 def readVal(f, numBytes):
     v,_ = binaryToVal(f.read(numBytes), numBytes)
     return v
 
+def unpackVals(s, numBytes, count, start=0):
+    ''' Read count values, each stored in numBytes bytes, starting at the given index of s without copying it.
+        Returns the list of values and the index following the last one
+    '''
+
+    end = start + numBytes * count
+    if numBytes in formats:
+        vals = list(unpack_from('>%d%s' % (count, formats[numBytes]), s, start))
+    else:
+        view = memoryview(s)
+        vals = [int.from_bytes(view[i:i+numBytes], byteorder='big') for i in range(start, end, numBytes)]
+    return vals, end
+
+def unpackValPairs(s, numBytesA, numBytesB, count, start=0):
+    ''' Read count pairs of values in the format written by packValPairs(), starting at the given index of s.
+        Returns a list of (a, b) tuples and the index following the last pair
+    '''
+
+    pairBytes = numBytesA + numBytesB
+    end = start + pairBytes * count
+    view = memoryview(s)[start:end]
+    if numBytesA in formats and numBytesB in formats:
+        pairs = list(Struct('>' + formats[numBytesA] + formats[numBytesB]).iter_unpack(view))
+    else:
+        pairs = [(int.from_bytes(view[i:i+numBytesA], byteorder='big'), int.from_bytes(view[i+numBytesA:i+pairBytes], byteorder='big')) for i in range(0, end-start, pairBytes)]
+    return pairs, end
+
+def packVarints(vals):
+    ''' Convert a list of non-negative values to a byte string of LEB128 varints, 7 bits per byte with the high bit set on all but the last byte of each value
+    '''
+
+    s = bytearray()
+    for v in vals:
+        while v >= 0x80:
+            s.append((v & 0x7f) | 0x80)
+            v >>= 7
+        s.append(v)
+    return bytes(s)
+
+def unpackVarints(s, count, start=0):
+    ''' Read count varints in the format written by packVarints(), starting at the given index of s.
+        Returns the list of values and the index following the last one
+    '''
+
+    # Most values fit in a single byte, in which case the bytes are the values
+    run = bytes(s[start:start+count])
+    if len(run) == count and run.isascii():
+        return list(run), start+count
+
+    vals = [0] * count
+    i = start
+    for k in range(count):
+        b = s[i]
+        i += 1
+        v = b & 0x7f
+        shift = 7
+        while b >= 0x80:
+            b = s[i]
+            i += 1
+            v |= (b & 0x7f) << shift
+            shift += 7
+        vals[k] = v
+    return vals, i
+
+def binaryToVarint(s, start=0):
+    ''' Read a single varint from s. Returns the value and the index following it
+    '''
+
+    vals, start = unpackVarints(s, 1, start)
+    return vals[0], start
+
+def skipVarints(s, count, start=0):
+    ''' Return the index following the next count varints in s
+    '''
+
+    i = start
+    while count > 0:
+        if s[i] < 0x80:
+            count -= 1
+        i += 1
+    return i
+
+def zigzag(val):
+    ''' Map a signed value to a non-negative one, so that values of small magnitude have short varints
+    '''
+
+    if val < 0:
+        return -2*val - 1
+    return 2*val
+
+def unzigzag(val):
+    ''' Inverse of zigzag()
+    '''
+
+    if val & 1:
+        return -((val+1) >> 1)
+    return val >> 1
+
+# Magic bytes at the very end of a compressed file. Files written before the trailer was introduced, which begin with their index, do not have them
+trailerMagic = b'BLT\x01'
+
+# Size in bytes of the trailer at the end of a compressed file, which records the codec, locates the cross-bundle section and the index footer, and ends with trailerMagic
+trailerSize = 17 + len(trailerMagic)
+
+def writeTrailer(f, compressMethod, crossBundleStart, footerStart, version=formatVersion):
+    ''' Write the fixed-size trailer that ends a compressed file.
+        The first byte holds the codec id in its low 4 bits and the format version in its high 4 bits
+    '''
+
+    writeVal(f, 1, (version << 4) | compressMethod)
+    writeVal(f, 8, crossBundleStart)
+    writeVal(f, 8, footerStart)
+    f.write(trailerMagic)
+
+def isLegacyFile(f):
+    ''' Return True if f does not end with a trailer, i.e. it was written by a version of Boiler that stored the index at the start of the file
+    '''
+
+    f.seek(0, 2)
+    if f.tell() < trailerSize:
+        return True
+    f.seek(-len(trailerMagic), 2)
+    return not f.read(len(trailerMagic)) == trailerMagic
+
+def seekFooter(f):
+    ''' Move to the index footer of a compressed file, which contains the preset dictionary, chromosomes, bundles and bundle lengths in that order.
+        Returns the id of the codec used to compress the file, the preset dictionary (or None), the offset of the cross-bundle section and the format version.
+        The file is left positioned at the chromosomes. Bundles begin at the start of the file.
+    '''
+
+    if isLegacyFile(f):
+        print('Error! Unsupported legacy .bl format: the file has no trailer, so it was written by an older version of Boiler or is not a Boiler file. Recompress the alignments with this version of Boiler')
+        exit()
+
+    f.seek(-trailerSize, 2)
+    codec = readVal(f, 1)
+    crossBundleStart = readVal(f, 8)
+    footerStart = readVal(f, 8)
+
+    compressMethod = codec & 0xf
+    version = codec >> 4
+    if version > formatVersion:
+        print('Error! File was written in format version %d, but this version of Boiler only supports up to version %d' % (version, formatVersion))
+        exit()
+
+    f.seek(footerStart)
+    zdict = readPresetDict(f)
+    return compressMethod, zdict, crossBundleStart, version
+
+def writePresetDict(zdict):
+    ''' Write the zlib preset dictionary shared by all blocks, compressed on its own. An empty dictionary is written as length 0
+    '''
+
+    if not zdict:
+        return valToBinary(4, 0)
+
+    s = zlib.compress(zdict, 9)
+    return valToBinary(4, len(s)) + s
+
+def readPresetDict(f):
+    ''' Read the preset dictionary written by writePresetDict(). Returns None if the file has no dictionary
+    '''
+
+    length = readVal(f, 4)
+    if length == 0:
+        return None
+    return zlib.decompress(f.read(length))
+
 def writeChroms(chroms):
     # find length in bytes to fit all numbers
     numBytes = findNumBytes(max(chroms[1]))
 
+    w = BinaryWriter()
+
     # Write keys
-    s = bytes('\t'.join(chroms[0]) + '\n', 'UTF-8')
+    w.write(bytes('\t'.join(chroms[0]) + '\n', 'UTF-8'))
 
     # Write values
-    s += valToBinary(1, numBytes)
-    for l in chroms[1]:
-        s += valToBinary(numBytes, l)
+    w.writeVal(1, numBytes)
+    w.writeVals(numBytes, chroms[1])
 
-    return s
+    return w.getValue()
 
 def readChroms(f):
     line = f.readline().decode('ascii')
@@ -62,22 +350,21 @@ def writeDict(d):
     valBytes = findNumBytes(maxVal)
 
     # Write keys
-    s = bytes(','.join(keys) + '\n', 'UTF-8')
+    keyStr = bytes(','.join(keys) + '\n', 'UTF-8')
 
     # Add length of keys string to beginning
-    s = valToBinary(4, len(s)) + s
+    w = BinaryWriter()
+    w.writeVal(4, len(keyStr))
+    w.write(keyStr)
 
     # Write values
-    s += valToBinary(1, valBytes)
-    for v in vals:
-        s += valToBinary(valBytes, v)
-    return s
+    w.writeVal(1, valBytes)
+    w.writeVals(valBytes, vals)
+    return w.getValue()
 
 def readDict(s, start=0):
     ''' Generic method to read a dictionary with string keys and integer values in the format written by writeDict() '''
 
-    d = []
-
     # Read length of keys string
     keyLen, start = binaryToVal(s, 4, start)
 
@@ -90,9 +377,8 @@ def readDict(s, start=0):
     valBytes, start = binaryToVal(s, 1, start)
 
     # Read values
-    for k in keys:
-        v, start = binaryToVal(s, valBytes, start)
-        d.append((k,v))
+    vals, start = unpackVals(s, valBytes, len(keys), start)
+    d = list(zip(keys, vals))
 
     return d
 
@@ -104,30 +390,21 @@ def writeList(vals):
     # find length in bytes to fit all numbers
     valBytes = findNumBytes(maxVal)
 
-    s = valToBinary(1, valBytes)
-    s += valToBinary(4, len(vals))
-    for v in vals:
-        s += valToBinary(valBytes, v)
-    return s
+    w = BinaryWriter()
+    w.writeVal(1, valBytes)
+    w.writeVal(4, len(vals))
+    w.writeVals(valBytes, vals)
+    return w.getValue()
 
 def readList(s, start=0):
     ''' Generic method to read a list of integers in the format written by writeList() '''
-    valBytes, start = binaryToVal(s, 1, start)
-    numVals, start = binaryToVal(s, 4, start)
-
-    vals = [0] * numVals
-    for i in range(numVals):
-        vals[i], start = binaryToVal(s, valBytes, start)
-    return vals, start
+    valBytes, numVals = unpack_from('>BI', s, start)
+    return unpackVals(s, valBytes, numVals, start+5)
 
 def readListFromFile(f):
     ''' Generic method to read a list of integers in the format written by writeList() '''
-    valBytes = readVal(f, 1)
-    numVals = readVal(f, 4)
-
-    vals = [0] * numVals
-    for i in range(numVals):
-        vals[i] = readVal(f, valBytes)
+    valBytes, numVals = unpack('>BI', f.read(5))
+    vals, _ = unpackVals(f.read(valBytes * numVals), valBytes, numVals)
     return vals
 
 def writeExons(exons):
@@ -140,31 +417,44 @@ def writeExons(exons):
     # length in bytes to fit all exon ids
     numExonBytes = findNumBytes(len(exons))
 
-    s = valToBinary(1, exonBytes)
-    #s += valToBinary(1, numExonBytes)
-    s += valToBinary(numExonBytes, len(exons))
-    for e in exons:
-        s += valToBinary(exonBytes, e)
+    w = BinaryWriter()
+    w.writeVal(1, exonBytes)
+    #w.writeVal(1, numExonBytes)
+    w.writeVal(numExonBytes, len(exons))
+    w.writeVals(exonBytes, exons)
 
-    return s, numExonBytes
+    return w.getValue(), numExonBytes
 
 def readExons(f, numExonBytes):
     ''' Read the list of exons '''
     exonBytes = readVal(f, 1)
     numExons = readVal(f, numExonBytes)
 
-    exons = []
-    for _ in range(numExons):
-        exons.append(readVal(f, exonBytes))
+    exons, _ = unpackVals(f.read(exonBytes * numExons), exonBytes, numExons)
     return exons
 
-def writeClusters(clusters):
+def writeClusters(clusters, version=formatVersion):
     '''
 
     :param clusters: 2d list of splice sites, grouped by cluster
+    :param version: File format version. From version 1, each splice site is stored as a varint delta from the previous one in its cluster,
+                    and the first site of each cluster as a signed delta from the first site of the previous cluster
     :return:
     '''
 
+    if version >= 1:
+        w = BinaryWriter()
+        w.writeVarint(len(clusters))
+        prevStart = 0
+        for c in clusters:
+            w.writeVarint(len(c))
+            if len(c) == 0:
+                continue
+            w.writeVarint(zigzag(c[0] - prevStart))
+            w.writeVarints([c[i] - c[i-1] for i in range(1, len(c))])
+            prevStart = c[0]
+        return w.getValue()
+
     maxExon = clusters[-1][-1]
 
     # find length in bytes to fit all numbers
@@ -177,46 +467,98 @@ def writeClusters(clusters):
             max_exons = len(c)
     exonIdBytes = findNumBytes(max_exons)
 
-    s = valToBinary(1, exonBytes)
-    s += valToBinary(1, exonIdBytes)
-    s += valToBinary(exonBytes, len(clusters))
+    w = BinaryWriter()
+    w.writeVal(1, exonBytes)
+    w.writeVal(1, exonIdBytes)
+    w.writeVal(exonBytes, len(clusters))
     for c in clusters:
-        s += valToBinary(exonIdBytes, len(c))
-        for e in c:
-            s += valToBinary(exonBytes, e)
+        w.writeVal(exonIdBytes, len(c))
+        w.writeVals(exonBytes, c)
 
-    return s
+    return w.getValue()
 
-def readClusters(f):
-    exonBytes = readVal(f, 1)
-    exonIdBytes = readVal(f, 1)
+def readClusters(f, version=formatVersion):
+    ''' Read the clusters written by writeClusters().
+        The size of the table is not stored, so the rest of the file is read at once and f is left at the end of the table
+    '''
+
+    pos = f.tell()
+    s = f.read()
 
-    clusters = []
-    num_c = readVal(f, exonBytes)
+    clusters, _, start = readClusterTable(s, version)
 
+    f.seek(pos + start)
+    return clusters
+
+def readClusterTable(s, version=formatVersion):
+    ''' Read a cluster table from the start of s.
+        Returns the list of clusters, the index in s of each cluster followed by the index of the end of the table, and the index of the end of the table
+    '''
+
+    num_c, widths, start = readClusterHeader(s, version)
+
+    clusters = [None] * num_c
+    entries = [0] * (num_c+1)
+    prevStart = 0
     for i in range(num_c):
-        num_e = readVal(f, exonIdBytes)
+        entries[i] = start
+        clusters[i], start = readCluster(s, start, prevStart, widths, version)
+        if clusters[i]:
+            prevStart = clusters[i][0]
+    entries[num_c] = start
+
+    return clusters, entries, start
+
+def readClusterHeader(s, version=formatVersion):
+    ''' Read the header of a cluster table.
+        Returns the number of clusters, the value widths needed by readCluster() and the index of the first cluster
+    '''
+
+    if version >= 1:
+        num_c, start = binaryToVarint(s)
+        return num_c, None, start
+
+    exonBytes, exonIdBytes = unpack_from('BB', s, 0)
+    num_c, start = binaryToVal(s, exonBytes, 2)
+    return num_c, (exonBytes, exonIdBytes), start
+
+def readCluster(s, start, prevStart, widths, version=formatVersion):
+    ''' Read the splice sites of a single cluster at the given index of a cluster table.
+        prevStart is the first splice site of the last non-empty cluster before this one (or 0), against which version 1 tables are delta-coded.
+        Returns the list of splice sites and the index following the cluster
+    '''
+
+    if version >= 1:
+        num_e, start = binaryToVarint(s, start)
+        if num_e == 0:
+            return [], start
+        first, start = binaryToVarint(s, start)
+        deltas, start = unpackVarints(s, num_e-1, start)
+
         splice_sites = [0] * num_e
-        for j in range(num_e):
-            splice_sites[j] = readVal(f, exonBytes)
-        clusters.append(splice_sites)
+        site = prevStart + unzigzag(first)
+        splice_sites[0] = site
+        for j in range(1, num_e):
+            site += deltas[j-1]
+            splice_sites[j] = site
+        return splice_sites, start
 
-    return clusters
+    exonBytes, exonIdBytes = widths
+    num_e, start = binaryToVal(s, exonIdBytes, start)
+    return unpackVals(s, exonBytes, num_e, start)
 
 def writeJunctionsList(junctions, exonBytes):
-    s = valToBinary(4, len(junctions))
-    s += valToBinary(1, exonBytes)
+    w = BinaryWriter()
+    w.writeVal(4, len(junctions))
+    w.writeVal(1, exonBytes)
 
     for j in junctions:
-        j = j.split('\t')
-
         # First byte: XS value, 0 = None, -1 = -, 1 = +
         # Second byte: Number of exons in junction
         # These could probably be combined into a single byte, but I'm keeping them separate just in case
         #   a junction ever contains more than 64 subexons
-        strand = int(j[-2])
-        s += pack('b', strand)
-        s += pack('B', len(j)-2)
+        strand = j[-2]
+        w.write(pack('bB', strand, len(j)-2))
 
         '''
         if j[-2] == '-':
@@ -225,11 +567,10 @@ def writeJunctionsList(junctions, exonBytes):
             s += pack('b', len(j)-2)
         '''
         
-        for e in j[:-2]:
-            s += valToBinary(exonBytes, int(e))
-        s += valToBinary(2, int(j[-1]))
+        w.writeVals(exonBytes, j[:-2])
+        w.writeVal(2, j[-1])
 
-    return s
+    return w.getValue()
 
 def readJunctionsList(s, start=0):
     numJunctions, start = binaryToVal(s, 4, start)
@@ -237,17 +578,14 @@ def readJunctionsList(s, start=0):
 
     junctions = [[]] * numJunctions
     for j in range(numJunctions):
-        # Read xs value
-        v = unpack_from('b', s[start:start+1])[0]
+        # Read xs value and number of exons
+        v, num_exons = unpack_from('bB', s, start)
         strand = None
         if v == -1:
             strand = '-'
         elif v == 1:
             strand = '+'
 
-        # Read number of exons
-        num_exons = unpack_from('B', s[start+1:start+2])[0]
-
         start += 2
 
         '''
@@ -265,65 +603,117 @@ def readJunctionsList(s, start=0):
         '''
 
         # Read exons
-        juncExons = [0] * num_exons
-        for e in range(num_exons):
-            juncExons[e], start = binaryToVal(s, exonBytes, start)
+        juncExons, start = unpackVals(s, exonBytes, num_exons, start)
 
         # Read NH value
-        NH, start = binaryToVal(s, 2, start)
+        NH = unpack_from('>H', s, start)[0]
+        start += 2
 
         # Create junction string
         junctions[j] = juncExons + [strand, NH]
 
     return junctions, exonBytes, start
 
-def writeJunction(readLenBytes, junc):
-    #s = writeCov(junc.coverage)
-    s = writeCov(RLE(junc.coverage))
-    covSize = len(s)
-    s += writeLens(readLenBytes, junc.unpairedLens)
+def writeBundleBlock(streams):
+    ''' Combine the compressed streams of a bundle into a block. A single stream is written in the row layout, and a coverage stream followed by a length stream in the columnar layout
+    '''
+
+    w = BinaryWriter()
+    if len(streams) == 1:
+        w.writeVal(1, layoutRow)
+    else:
+        w.writeVal(1, layoutColumnar)
+        w.writeVarint(len(streams[0]))
+    for s in streams:
+        w.write(s)
+    return w.getValue()
+
+def splitBundleBlock(block, version=formatVersion):
+    ''' Split a block written by writeBundleBlock() into its compressed streams
+    '''
+
+    if version < 2:
+        return [block]
+    if block[0] == layoutRow:
+        return [block[1:]]
+
+    covLen, start = binaryToVarint(block, 1)
+    return [block[start:start+covLen], block[start+covLen:]]
+
+def writeJunction(readLenBytes, junc, version=formatVersion):
+    covStr = writeCov(RLEFromChanges(junc.covChanges, junc.length), version)
+    lensStr = writeJunctionLens(readLenBytes, junc, version)
+    return covStr + lensStr, len(covStr), len(covStr) + len(lensStr)
+
+def writeJunctionLens(readLenBytes, junc, version=formatVersion):
+    ''' Write the length distributions of a bucket, which follow its coverage vector in the row layout
+    '''
+
+    w = BinaryWriter()
+    w.write(writeLens(readLenBytes, junc.unpairedLens, version))
 
     # Find max number of bytes needed to encode fragment lengths
     if len(junc.pairedLens) == 0:
         fragLenBytes = 1
     else:
         fragLenBytes = findNumBytes(max(junc.pairedLens))
-    s += valToBinary(1, fragLenBytes)
-    s += writeLens(fragLenBytes, junc.pairedLens)
+    w.writeVal(1, fragLenBytes)
+    w.write(writeLens(fragLenBytes, junc.pairedLens, version))
     if len(junc.pairedLens) > 0:
-        s += writeLens(readLenBytes, junc.lensLeft)
+        w.write(writeLens(readLenBytes, junc.lensLeft, version))
         if len(junc.lensLeft) > 0:
-            s += writeLens(readLenBytes, junc.lensRight)
+            w.write(writeLens(readLenBytes, junc.lensRight, version))
 
-    totalSize = len(s)
+    return w.getValue()
 
-    return s, covSize, totalSize
+def readJunction(s, junc, readLenBytes, start=0, version=formatVersion):
+    junc.coverage, start = readCov(s, start, version)
+    return junc, readJunctionLens(s, junc, readLenBytes, start, version)
+
+def readJunctionLens(s, junc, readLenBytes, start=0, version=formatVersion):
+    ''' Read the length distributions written by writeJunctionLens() into junc. Returns the index following them
+    '''
 
-def readJunction(s, junc, readLenBytes, start=0):
-    junc.coverage, start = readCov(s, start)
-    junc.unpairedLens, start = readLens(s, readLenBytes, start)
+    junc.unpairedLens, start = readLens(s, readLenBytes, start, version)
 
     fragLenBytes, start = binaryToVal(s, 1, start)
-    junc.pairedLens, start = readLens(s, fragLenBytes, start)
+    junc.pairedLens, start = readLens(s, fragLenBytes, start, version)
 
     if len(junc.pairedLens) > 0:
-        junc.lensLeft, start = readLens(s, readLenBytes, start)
+        junc.lensLeft, start = readLens(s, readLenBytes, start, version)
         if len(junc.lensLeft) > 0:
-            junc.lensRight, start = readLens(s, readLenBytes, start)
+            junc.lensRight, start = readLens(s, readLenBytes, start, version)
 
-    return junc, start
+    return start
 
 def writeCrossBundleBucketNames(bundleIdBytes, buckets, buckets_sorted):
-    s = b''
+    w = BinaryWriter()
 
     for b in buckets_sorted:
-        bucket = buckets[b]
-        s += valToBinary(bundleIdBytes, bucket.bundleA)
-        s += writeList(bucket.exonIdsA)
-        s += valToBinary(bundleIdBytes, bucket.bundleB)
-        s += writeList(bucket.exonIdsB)
+        w.write(writeCrossBundleBucketName(bundleIdBytes, buckets[b]))
+
+    return w.getValue()
+
+def writeCrossBundleBucketName(bundleIdBytes, bucket):
+    ''' Write the bundles and exons spanned by a cross-bundle bucket
+    '''
+
+    w = BinaryWriter()
+    w.writeVal(bundleIdBytes, bucket.bundleA)
+    w.write(writeList(bucket.exonIdsA))
+    w.writeVal(bundleIdBytes, bucket.bundleB)
+    w.write(writeList(bucket.exonIdsB))
+    return w.getValue()
 
-    return s
+def readCrossBundleBucketName(s, bundleIdBytes, start=0):
+    ''' Read a name written by writeCrossBundleBucketName(). Returns a new CrossBundleBucket and the index following the name
+    '''
+
+    bundleA, start = binaryToVal(s, bundleIdBytes, start)
+    exonIdsA, start = readList(s, start)
+    bundleB, start = binaryToVal(s, bundleIdBytes, start)
+    exonIdsB, start = readList(s, start)
+    return cross_bundle_bucket.CrossBundleBucket(bundleA, exonIdsA, bundleB, exonIdsB), start
 
 def readCrossBundleBucketNames(s, num_buckets, bundleIdBytes, start=0):
     buckets = [0] * num_buckets
@@ -353,51 +743,50 @@ def readCrossBundleBucketNames(s, num_buckets, bundleIdBytes, start=0):
 
     return buckets, start
 
-def writeCrossBundleBucket(readLenBytes, bucket):
-    #s = valToBinary(bundleIdBytes, bucket.bundleA)
-    #s += writeList(bucket.exonIdsA)
-    #s += valToBinary(bundleIdBytes, bucket.bundleB)
-    #s += writeList(bucket.exonIdsB)
-    s = pack('b', bucket.strand)
-    s += valToBinary(1, bucket.NH)
+def writeCrossBundleBucket(readLenBytes, bucket, version=formatVersion):
+    #w.writeVal(bundleIdBytes, bucket.bundleA)
+    #w.write(writeList(bucket.exonIdsA))
+    #w.writeVal(bundleIdBytes, bucket.bundleB)
+    #w.write(writeList(bucket.exonIdsB))
+    w = BinaryWriter()
+    w.write(pack('b', bucket.strand))
+    w.writeVal(1, bucket.NH)
 
-    l = len(s)
+    l = len(w)
 
-    s += writeCov(bucket.coverage)
+    w.write(writeCov(RLEFromChanges(bucket.covChanges, bucket.length), version))
 
-    covSize = len(s) - l
+    covSize = len(w) - l
 
     # Find max number of bytes needed to encode fragment lengths
     if len(bucket.pairedLens) == 0:
         fragLenBytes = 1
     else:
         fragLenBytes = findNumBytes(max(bucket.pairedLens))
-    s += valToBinary(1, fragLenBytes)
-    s += writeLens(fragLenBytes, bucket.pairedLens)
+    w.writeVal(1, fragLenBytes)
+    w.write(writeLens(fragLenBytes, bucket.pairedLens, version))
     if len(bucket.pairedLens) > 0:
-        s += writeLens(readLenBytes, bucket.lensLeft)
+        w.write(writeLens(readLenBytes, bucket.lensLeft, version))
         if len(bucket.lensLeft) > 0:
-            s += writeLens(readLenBytes, bucket.lensRight)
+            w.write(writeLens(readLenBytes, bucket.lensRight, version))
 
-    totalSize = len(s)
+    totalSize = len(w)
 
-    return s, covSize, totalSize
+    return w.getValue(), covSize, totalSize
 
-def readCrossBundleBucket(s, bucket, readLenBytes, start=0):
-    v = unpack_from('b', s[start:start+1])[0]
+def readCrossBundleBucket(s, bucket, readLenBytes, start=0, version=formatVersion):
+    v, NH = unpack_from('bB', s, start)
     strand = None
     if v == -1:
         strand = '-'
     elif v == 1:
         strand = '+'
-    start += 1
-
-    NH, start = binaryToVal(s, 1, start)
+    start += 2
 
     bucket.strand = strand
     bucket.NH = NH
 
-    coverage, start = readCov(s, start)
+    coverage, start = readCov(s, start, version)
     length = 0
     for c in coverage:
         length += c[1]
@@ -405,41 +794,44 @@ def readCrossBundleBucket(s, bucket, readLenBytes, start=0):
     bucket.coverage = coverage
 
     fragLenBytes, start = binaryToVal(s, 1, start)
-    bucket.pairedLens, start = readLens(s, fragLenBytes, start)
+    bucket.pairedLens, start = readLens(s, fragLenBytes, start, version)
 
     if len(bucket.pairedLens) > 0:
-        bucket.lensLeft, start = readLens(s, readLenBytes, start)
+        bucket.lensLeft, start = readLens(s, readLenBytes, start, version)
         if len(bucket.lensLeft) > 0:
-            bucket.lensRight, start = readLens(s, readLenBytes, start)
+            bucket.lensRight, start = readLens(s, readLenBytes, start, version)
 
     return start
 
-def skipCrossBundleBucket(s, readLenBytes, start=0):
+def skipCrossBundleBucket(s, readLenBytes, start=0, version=formatVersion):
     start += 2
 
-    start = skipCov(s, start)
+    start = skipCov(s, start, version)
 
     fragLenBytes, start = binaryToVal(s, 1, start)
-    paired, start = skipLens(s, fragLenBytes, start)
+    paired, start = skipLens(s, fragLenBytes, start, version)
 
     if paired:
-        left, start = skipLens(s, readLenBytes, start)
+        left, start = skipLens(s, readLenBytes, start, version)
         if left:
-            _, start = skipLens(s, readLenBytes, start)
+            _, start = skipLens(s, readLenBytes, start, version)
 
     return start
 
-def skipJunction(s, readLenBytes, start=0):
-    _, start = readCov(s, start)
-    _, start = readLens(s, readLenBytes, start)
+def skipJunction(s, readLenBytes, start=0, version=formatVersion):
+    start = skipCov(s, start, version)
+    return skipJunctionLens(s, readLenBytes, start, version)
+
+def skipJunctionLens(s, readLenBytes, start=0, version=formatVersion):
+    _, start = skipLens(s, readLenBytes, start, version)
 
     fragLenBytes, start = binaryToVal(s, 1, start)
-    lens, start = readLens(s, fragLenBytes, start)
+    paired, start = skipLens(s, fragLenBytes, start, version)
 
-    if len(lens) > 0:
-        lens, start = readLens(s, readLenBytes, start)
-        if len(lens) > 0:
-            _, start = readLens(s, readLenBytes, start)
+    if paired:
+        left, start = skipLens(s, readLenBytes, start, version)
+        if left:
+            _, start = skipLens(s, readLenBytes, start, version)
 
     return start
 
@@ -459,45 +851,60 @@ def skipJunction(s, readLenBytes, start=0):
     return start
 '''
 
-def writeLens(lenBytes, lens):
+def writeLens(lenBytes, lens, version=formatVersion):
+    ''' Write a distribution of lengths. From version 1, lengths and frequencies are stored as varints and lenBytes is ignored
+    '''
+
+    if version >= 1:
+        w = BinaryWriter()
+        w.writeVarint(len(lens))
+        w.writeVarints([v for pair in lens.items() for v in pair])
+        return w.getValue()
+
     # Write number of lengths
-    s = valToBinary(2, len(lens))
+    w = BinaryWriter()
+    w.writeVal(2, len(lens))
 
     if len(lens) > 0:
         # Write number of bytes for each frequency
         freqBytes = findNumBytes(max(lens.values()))
-        s += valToBinary(1, freqBytes)
+        w.writeVal(1, freqBytes)
+        w.writeValPairs(lenBytes, freqBytes, lens.items())
 
-        for l,n in lens.items():
-            s += valToBinary(lenBytes, l)
-            s += valToBinary(freqBytes, n)
+    return w.getValue()
 
-    return s
+def readLens(s, lenBytes, start=0, version=formatVersion):
+    if version >= 1:
+        numLens, start = binaryToVarint(s, start)
+        vals, start = unpackVarints(s, 2*numLens, start)
+        return dict(zip(vals[0::2], vals[1::2])), start
 
-def readLens(s, lenBytes, start=0):
     # Read number of lengths
-    numLens, start = binaryToVal(s, 2, start)
+    numLens = unpack_from('>H', s, start)[0]
+    start += 2
     lens = dict()
 
     if numLens > 0:
         # Read number of bytes for each frequency
-        freqBytes, start = binaryToVal(s, 1, start)
-
-        for _ in range(numLens):
-            l, start = binaryToVal(s, lenBytes, start)
-            n, start = binaryToVal(s, freqBytes, start)
-            lens[l] = n
+        freqBytes = s[start]
+        pairs, start = unpackValPairs(s, lenBytes, freqBytes, numLens, start+1)
+        lens = dict(pairs)
 
     return lens, start
 
-def skipLens(s, lenBytes, start=0):
-    numLens, start = binaryToVal(s, 2, start)
+def skipLens(s, lenBytes, start=0, version=formatVersion):
+    if version >= 1:
+        numLens, start = binaryToVarint(s, start)
+        return numLens > 0, skipVarints(s, 2*numLens, start)
+
+    numLens = unpack_from('>H', s, start)[0]
+    start += 2
 
     if numLens == 0:
         return False, start
     else:
-        freqBytes, start = binaryToVal(s, 1, start)
-        start += (lenBytes+freqBytes) * numLens
+        freqBytes = s[start]
+        start += 1 + (lenBytes+freqBytes) * numLens
         return True, start
 
 def writePairs(pairs, numBytes=3):
@@ -510,10 +917,10 @@ def writePairs(pairs, numBytes=3):
 
     numBytes = 3
 
-    s = valToBinary(numBytes, len(pairs))
-    for p in pairs:
-        s += valToBinary(numBytes, p[0]) + valToBinary(numBytes, p[1])
-    return s
+    w = BinaryWriter()
+    w.writeVal(numBytes, len(pairs))
+    w.writeValPairs(numBytes, numBytes, pairs)
+    return w.getValue()
 
 def readPairs(s, start=0, numBytes=3):
     '''
@@ -526,14 +933,18 @@ def readPairs(s, start=0, numBytes=3):
     numBytes = 3
 
     length, start = binaryToVal(s, numBytes, start)
-    pairs = [None] * length
-    for i in range(length):
-        a, start = binaryToVal(s, numBytes, start)
-        b, start = binaryToVal(s, numBytes, start)
-        pairs[i] = (a,b)
-    return pairs, start
-
-def writeCov(cov):
+    return unpackValPairs(s, numBytes, numBytes, length, start)
+
+def writeCov(cov, version=formatVersion):
+    ''' Write a run-length encoded coverage vector. From version 1, coverage values and run lengths are stored as varints
+    '''
+
+    if version >= 1:
+        w = BinaryWriter()
+        w.writeVarint(len(cov))
+        w.writeVarints([v for run in cov for v in run])
+        return w.getValue()
+
     maxLen = 0
     maxCov = 0
     for c in cov:
@@ -549,46 +960,44 @@ def writeCov(cov):
     covBytes = findNumBytes(maxCov)
 
     # Write size of length and cov in bytes
-    s = valToBinary(1, lenBytes)
-    s += valToBinary(1, covBytes)
+    w = BinaryWriter()
+    w.writeVal(1, lenBytes)
+    w.writeVal(1, covBytes)
 
     # Write the length of the vector
-    s += valToBinary(4, len(cov))
+    w.writeVal(4, len(cov))
 
-    for c in cov:
-        s += valToBinary(covBytes, c[0])
-        s += valToBinary(lenBytes, c[1])
+    w.writeValPairs(covBytes, lenBytes, cov)
 
-    return s
+    return w.getValue()
 
-def readCov(s, start=0):
-    # Read size of length and cov in bytes
-    lenBytes, start = binaryToVal(s, 1, start)
-    covBytes, start = binaryToVal(s, 1, start)
+def readCov(s, start=0, version=formatVersion):
+    if version >= 1:
+        lenCov, start = binaryToVarint(s, start)
+        vals, start = unpackVarints(s, 2*lenCov, start)
+        return [[vals[i], vals[i+1]] for i in range(0, 2*lenCov, 2)], start
 
-    # Read the length of the vector
-    lenCov, start = binaryToVal(s, 4, start)
+    # Read size of length and cov in bytes, and the length of the vector
+    lenBytes, covBytes, lenCov = unpack_from('>BBI', s, start)
 
-    cov = []
-    for _ in range(lenCov):
-        c, start = binaryToVal(s, covBytes, start)
-        l, start = binaryToVal(s, lenBytes, start)
-        cov.append([c,l])
-        #cov += [c] * l
+    pairs, start = unpackValPairs(s, covBytes, lenBytes, lenCov, start+6)
+    cov = [[c,l] for c,l in pairs]
+    #cov += [c] * l
 
     return cov, start
 
-def skipCov(s, start=0):
+def skipCov(s, start=0, version=formatVersion):
     '''
     Skip a compressed coverage vector
     '''
-    lenBytes, start = binaryToVal(s, 1, start)
-    covBytes, start = binaryToVal(s, 1, start)
 
-    # Read the length of the vector
-    lenCov, start = binaryToVal(s, 4, start)
+    if version >= 1:
+        lenCov, start = binaryToVarint(s, start)
+        return skipVarints(s, 2*lenCov, start)
+
+    lenBytes, covBytes, lenCov = unpack_from('>BBI', s, start)
 
-    return start + lenCov * (lenBytes + covBytes)
+    return start + 6 + lenCov * (lenBytes + covBytes)
 
 def RLE(vector):
     rle = []
@@ -606,6 +1015,31 @@ def RLE(vector):
 
     return rle
 
+def RLEFromChanges(changes, length):
+    ''' Run length encode a coverage vector of the given length, stored as a dictionary containing the change in coverage at each offset where it changes.
+        Returns the same runs as RLE() would for the full vector
+    '''
+
+    rle = []
+    val = 0
+    pos = 0
+    for p in sorted(changes):
+        if p >= length:
+            break
+
+        delta = changes[p]
+        if delta == 0:
+            continue
+
+        if p > pos:
+            rle.append([val, p - pos])
+            pos = p
+        val += delta
+
+    rle.append([val, length - pos])
+
+    return rle
+
 def findNumBytes(val):
     ''' Return the number of bytes needed to encode the given value.
         Will only return 1, 2, 4, or 8 (the number of bytes that struct.pack supports)
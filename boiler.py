@@ -4,6 +4,7 @@ import argparse
 import time
 import logging
 import os
+import random
 
 VERSION = '1.0.1'
 
@@ -16,6 +17,10 @@ def go(args):
         import compress
 
         if args.preprocess:
+            if args.alignments == '-':
+                print('Preprocessing is not supported when reading alignments from standard input')
+                exit()
+
             modes = ['hisat']
             if args.preprocess.lower() == 'hisat':
                 print('Preprocessing HISAT alignments')
@@ -23,18 +28,23 @@ def go(args):
                 prefix = args.alignments[:args.alignments.index('.')] + '.processed'
                 enumeratePairs.processHISAT(args.alignments, prefix + '.sam')
                 os.system('samtools view -bS ' + prefix + '.sam | samtools sort - ' + prefix)
-                os.system('samtools view -h -o ' + prefix + '.sam ' + prefix + '.bam')
             else:
                 print('Preprocessing mode not recognized: %s' % args.preprocess)
                 print('Supported preprocessing modes include: ' + ', '.join(modes))
                 exit()
-            args.alignments = prefix + '.sam'
+            args.alignments = prefix + '.bam'
+
+        if args.level != None:
+            min_level = 1 if args.codec == 'bz2' else 0
+            if args.level < min_level or args.level > 9:
+                print('Compression level for %s must be between %d and 9' % (args.codec, min_level))
+                exit()
 
         if args.verbose:
             print('Compressing')
             start = time.time()
-        compressor = compress.Compressor(args.frag_len_cutoff)
-        compressor.compress(args.alignments, args.compressed, args.gtf, None, args.frag_len_z_cutoff, args.split_diff_strands, args.split_discordant)
+        compressor = compress.Compressor(args.frag_len_cutoff, args.threads, compress_method=compress.Compressor.codecs.index(args.codec), level=args.level, columnar=args.columnar)
+        compressor.compress(args.alignments, args.compressed, args.gtf, None, args.frag_len_z_cutoff, args.split_diff_strands, args.split_discordant, args.single_pass)
         if args.verbose:
             end = time.time()
             print('Compression took %0.3f s' % (end-start))
@@ -80,17 +90,37 @@ def go(args):
                 aligned, unpaired, paired = expander.getReads(args.compressed, args.chrom, args.start, args.end)
                 aligned.writeSAM(f, unpaired, paired, False, False, 0)
 
+    elif args.command == 'index':
+        import bundleIndex
+        import binaryIO
+
+        with binaryIO.MappedReader(args.compressed) as f:
+            if binaryIO.isLegacyFile(f):
+                print('Error! %s was written by an older version of Boiler and cannot be indexed. Recompress the alignments with this version of Boiler, then index the new file' % args.compressed)
+                exit()
+
+        index_name = bundleIndex.writeIndex(args.compressed)
+        print('Wrote index to %s' % index_name)
+
     elif args.command == 'decompress':
         import expand
 
+        # Keep messages out of the SAM output when it is written to standard output
+        if args.expanded == '-':
+            log = sys.stderr
+        else:
+            log = sys.stdout
+
         if args.verbose:
-            print('Decompressing')
+            print('Decompressing', file=log)
             start = time.time()
-        expander = expand.Expander(args.force_xs)
+        if not args.seed == None:
+            random.seed(args.seed)
+        expander = expand.Expander(args.force_xs, args.threads, args.bam, args.sorted)
         expander.expand(args.compressed, args.expanded)
         if args.verbose:
             end = time.time()
-            print('Decompression took %0.3f s' % (end-start))
+            print('Decompression took %0.3f s' % (end-start), file=log)
 
 if __name__ == '__main__':
 
@@ -117,8 +147,13 @@ if __name__ == '__main__':
     parser_compress.add_argument("-d", "--split-discordant", action="store_true", help='Treat discordant pairs as unpaired reads')
     parser_compress.add_argument("-p", "--preprocess", type=str, help="Set to 'tophat' to preprocess TopHat alignments, 'hisat' to preprocess HISAT alignments")
     parser_compress.add_argument("-g", "--gtf", type=str, help="Path to reference GTF to improve compression accuracy (this will result in larger file size)")
+    parser_compress.add_argument("-1", "--single-pass", action="store_true", help='Read the SAM file only once, estimating the fragment length cutoff and unpairing mates on different strands as it is compressed')
+    parser_compress.add_argument("-t", "--threads", type=int, default=1, help="Number of processes to use for compressing bundles. Default: 1")
+    parser_compress.add_argument("--codec", type=str, choices=['zlib', 'lzma', 'bz2'], default='zlib', help="Library used to compress each block. Default: zlib")
+    parser_compress.add_argument("--level", type=int, help="Compression level passed to the codec, from 0 (1 for bz2) to 9. Default: 6 for zlib and lzma, 9 for bz2")
+    parser_compress.add_argument("--columnar", action="store_true", help="Store the coverage vectors and length distributions of each bundle in separately compressed streams, so that coverage queries only decompress the coverage")
     parser_compress.add_argument("-v", "--verbose", help="Print timing information", action="store_true")
-    parser_compress.add_argument("alignments", type=str, help='Full path of SAM file containing aligned reads')
+    parser_compress.add_argument("alignments", type=str, help="Full path of SAM or BAM file containing aligned reads, or '-' to read from standard input")
     parser_compress.add_argument("compressed", type=str, nargs='?', default='compressed.bin', help="Compressed filename. Default: compressed.bin")
 
     parser_query = subparsers.add_parser('query', help="Query compressed file")
@@ -134,11 +169,18 @@ if __name__ == '__main__':
     parser_query.add_argument('compressed', help="Path to compressed file created by Boiler", type=str)
     parser_query.add_argument('output', nargs='?', default=None, help="File to write result to. Default: Standard out")
 
+    parser_index = subparsers.add_parser('index', help="Index a compressed file to speed up queries")
+    parser_index.add_argument('compressed', help="Path to compressed file created by Boiler", type=str)
+
     parser_decompress = subparsers.add_parser('decompress', help="Decompress to a SAM file")
     parser_decompress.add_argument("-f", "--force-xs", help="If we decompress a spliced read with no XS value, assign it a random one (so Cufflinks can run)", action="store_true")
     parser_decompress.add_argument("-v", "--verbose", help="Print timing information", action="store_true")
+    parser_decompress.add_argument("-t", "--threads", type=int, default=1, help="Number of processes to use for expanding bundles. Default: 1")
+    parser_decompress.add_argument("--bam", action="store_true", help="Write a BAM file instead of a SAM file")
+    parser_decompress.add_argument("--sorted", action="store_true", help="Sort the output by coordinate")
+    parser_decompress.add_argument("-s", "--seed", type=int, help="Seed for the XS values assigned by --force-xs, so that the output is reproducible")
     parser_decompress.add_argument("compressed", type=str, help="Compressed filename")
-    parser_decompress.add_argument("expanded", type=str, nargs='?', default='expanded.sam', help="Write decompressed SAM to this filename. Default: expanded.sam")
+    parser_decompress.add_argument("expanded", type=str, nargs='?', default='expanded.sam', help="Write decompressed SAM to this filename, or '-' to write to standard output. Default: expanded.sam")
 
     args = parser.parse_args(sys.argv[1:])
 
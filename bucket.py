@@ -1,3 +1,12 @@
+def addCoverage(changes, start, length):
+    ''' Add a read covering [start, start+length) to a coverage vector stored as the change in coverage at each offset where it changes.
+        Shared by Bucket and CrossBundleBucket
+    '''
+
+    changes[start] = changes.get(start, 0) + 1
+    end = start + length
+    changes[end] = changes.get(end, 0) - 1
+
 class Bucket:
     ''' A bucket spanned by at least 1 aligned read '''
 
@@ -23,7 +32,9 @@ class Bucket:
         self.lensRight = dict()
 
         #self.coverage = [[0, length]]
-        self.coverage = [0] * length
+
+        # Coverage vector stored as the change in coverage at each offset where it changes
+        self.covChanges = dict()
 
     def add_paired(self, p):
 
@@ -86,6 +97,7 @@ class Bucket:
     '''
 
     def updateCov(self, start, length):
-        for i in range(start, start+length):
-            self.coverage[i] += 1
+        ''' Add a read covering [start, start+length) to the coverage vector
+        '''
 
+        addCoverage(self.covChanges, start, length)
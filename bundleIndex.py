@@ -0,0 +1,177 @@
+import bisect
+import binaryIO
+import struct
+import zlib
+
+# Appended to the name of a compressed file to get the name of its index file
+indexExtension = '.bli'
+
+# Magic bytes and version at the start of every index file. The magic bytes and fingerprint are followed by the CRC32 of the rest of the file
+indexMagic = b'BLI\x02'
+
+class BundleIndex:
+    ''' Bounds and block offsets of the bundles in a compressed file.
+        Behaves as the list of splice sites in each bundle, decoding a bundle from the cluster table the first time it is accessed
+    '''
+
+    def __init__(self, starts, ends, offsets, table, entries, version):
+        '''
+        :param starts: First splice site of each bundle
+        :param ends: Last splice site of each bundle
+        :param offsets: Offset of each bundle block in the compressed file, followed by the offset of the end of the last block
+        :param table: Cluster table from the footer of the compressed file
+        :param entries: Index in table of each bundle, followed by the index of the end of the table
+        :param version: Format version of the compressed file
+        '''
+
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+        self.table = table
+        self.entries = entries
+        self.version = version
+
+        _, self.widths, _ = binaryIO.readClusterHeader(table, version)
+
+        # Splice sites of the bundles decoded so far
+        self.clusters = dict()
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self.starts)
+
+        c = self.clusters.get(i)
+        if c == None:
+            if i > 0:
+                prevStart = self.starts[i-1]
+            else:
+                prevStart = 0
+            c, _ = binaryIO.readCluster(self.table, self.entries[i], prevStart, self.widths, self.version)
+            self.clusters[i] = c
+        return c
+
+    def getLength(self, i):
+        ''' Return the length in bytes of the block for bundle i
+        '''
+
+        return self.offsets[i+1] - self.offsets[i]
+
+    def getRelevantBundles(self, start, end):
+        '''
+
+        :param start:
+        :param end:
+        :return: The start and end+1 index of all bundles that overlap [start,end)
+        '''
+
+        # Bundles are disjoint and sorted, so searching the starts alone gives the same position as searching the (start, end) bounds
+        i = bisect.bisect_left(self.starts, start)
+
+        if self.starts[i-1] <= start and self.ends[i-1] > start:
+            start_i = i-1
+        elif self.ends[i] > start:
+            start_i = i
+        else:
+            print('Error bisecting')
+            print('(%d,%d)' % (start,end))
+            print(list(zip(self.starts[i-3:i+3], self.ends[i-3:i+3])))
+            exit()
+
+        end_i = bisect.bisect_left(self.starts, end)
+
+        return start_i, end_i
+
+def buildIndex(f, version):
+    ''' Build the index of a compressed file from its footer, decoding every bundle.
+        f must be positioned at the cluster table, following the chromosomes
+    '''
+
+    s = f.read()
+    clusters, entries, end = binaryIO.readClusterTable(s, version)
+    lengths, _ = binaryIO.readList(s, end)
+
+    offsets = [0] * (len(lengths)+1)
+    for i in range(len(lengths)):
+        offsets[i+1] = offsets[i] + lengths[i]
+
+    index = BundleIndex([c[0] for c in clusters], [c[-1] for c in clusters], offsets, s[:end], entries, version)
+    index.clusters = dict(enumerate(clusters))
+    return index
+
+def getFingerprint(f):
+    ''' Return the size and trailer of a compressed file, which identify the file an index was built from
+    '''
+
+    f.seek(0, 2)
+    size = f.tell()
+    f.seek(-binaryIO.trailerSize, 2)
+    return binaryIO.valToBinary(8, size) + f.read(binaryIO.trailerSize)
+
+def writeIndex(compressedFilename):
+    ''' Write the index file for a compressed file, so that queries only decode the bundles they touch
+    '''
+
+    with binaryIO.MappedReader(compressedFilename) as f:
+        _, _, _, version = binaryIO.seekFooter(f)
+        binaryIO.readChroms(f)
+        tableStart = f.tell()
+        index = buildIndex(f, version)
+        fingerprint = getFingerprint(f)
+
+    w = binaryIO.BinaryWriter()
+    w.writeVal(8, tableStart)
+    w.write(binaryIO.writeList(index.starts))
+    w.write(binaryIO.writeList(index.ends))
+    w.write(binaryIO.writeList(index.offsets))
+    w.write(binaryIO.writeList(index.entries))
+    payload = w.getValue()
+
+    indexFilename = compressedFilename + indexExtension
+    with open(indexFilename, 'wb') as f:
+        f.write(indexMagic + fingerprint + binaryIO.valToBinary(4, zlib.crc32(payload)))
+        f.write(payload)
+
+    return indexFilename
+
+def readIndex(f, compressedFilename, version):
+    ''' Load the index of a compressed file from its index file, reading the cluster table without decoding it.
+        Returns None if there is no index file, it was built from a different file, or it is truncated or corrupt (its checksum does not match)
+    '''
+
+    try:
+        with open(compressedFilename + indexExtension, 'rb') as fi:
+            s = fi.read()
+    except IOError:
+        return None
+
+    fingerprint = getFingerprint(f)
+    start = len(indexMagic)
+    if not s[:start] == indexMagic or not s[start:start+len(fingerprint)] == fingerprint:
+        return None
+    start += len(fingerprint)
+
+    crc, start = binaryIO.binaryToVal(s, 4, start)
+    if not crc == zlib.crc32(s[start:]):
+        return None
+
+    try:
+        tableStart, start = binaryIO.binaryToVal(s, 8, start)
+        starts, start = binaryIO.readList(s, start)
+        ends, start = binaryIO.readList(s, start)
+        offsets, start = binaryIO.readList(s, start)
+        entries, start = binaryIO.readList(s, start)
+        if not start == len(s) or not len(ends) == len(starts) or not len(offsets) == len(starts)+1 or not len(entries) == len(starts)+1:
+            return None
+
+        f.seek(tableStart)
+        table = f.read(entries[-1])
+        if not len(table) == entries[-1]:
+            return None
+
+        return BundleIndex(starts, ends, offsets, table, entries, version)
+    except (struct.error, IndexError, ValueError):
+        # Fall back to building the index from the compressed file
+        return None
@@ -1,11 +1,53 @@
 import alignments
-import re
 import read
 import binaryIO
+import bamIO
+import samIO
 import math
-import os
 import preprocess
+import sys
 import time
+import collections
+import itertools
+import multiprocessing
+
+# Per-process state for bundle compression workers, set by initBundleWorker()
+worker_aligned = None
+worker_compressor = None
+
+def initBundleWorker(chromosomes, compress_method, level, columnar, zdict):
+    ''' Initialize a worker process to compute and compress bundles
+    '''
+    global worker_aligned, worker_compressor
+
+    worker_aligned = alignments.Alignments(chromosomes)
+    worker_compressor = Compressor(None, 1, compress_method=compress_method, level=level, columnar=columnar)
+    worker_compressor.zdict = zdict
+
+def encodeBundleWorker(exons, unpaired, paired):
+    ''' Compute the buckets for a finalized bundle and encode them in a worker process, without compressing them.
+        Returns the bundle as returned by Compressor.encodeBundle()
+    '''
+
+    worker_aligned.exons = exons
+    worker_aligned.unpaired = unpaired
+    worker_aligned.paired = paired
+
+    junctions, maxReadLen = worker_aligned.computeBuckets()
+    return worker_compressor.encodeBundle(junctions, maxReadLen)
+
+def compressBundleWorker(exons, unpaired, paired):
+    ''' Compute the buckets for a finalized bundle and compress them in a worker process.
+        Returns the compressed bundle along with its coverage and total size before compression
+    '''
+
+    return worker_compressor.compressBundle(encodeBundleWorker(exons, unpaired, paired))
+
+def compressEncodedWorker(encoded):
+    ''' Compress a bundle already encoded by encodeBundleWorker() in a worker process
+    '''
+
+    return worker_compressor.compressBundle(encoded)
 
 class Compressor:
     aligned = None
@@ -14,11 +56,38 @@ class Compressor:
     # 1 - lzma
     # 2 - bz2
     compressMethod = 0
+    codecs = ['zlib', 'lzma', 'bz2']
+
+    # Compression level used by each codec if none is given
+    defaultLevels = [6, 6, 9]
+
+    # Candidate sizes of the zlib preset dictionary shared by all blocks. Leave empty to compress each block independently
+    dictSizes = [1024, 4096, 16384]
+
+    # Length of the substrings that make up the preset dictionary
+    dictGramLen = 8
+
+    # Total size of the encoded bundles sampled to build the preset dictionary
+    dictSampleSize = 1048576
+
+    # Preset dictionary, if one is in use
+    zdict = None
+
+    # Pool of worker processes compressing bundles, if num_threads > 1
+    pool = None
 
     covSize = 0
     totalSize = 0
 
-    def __init__(self, frag_len_cutoff):
+    def __init__(self, frag_len_cutoff, num_threads=1, compress_method=0, level=None, columnar=False):
+        self.compressMethod = compress_method
+        if level == None:
+            level = self.defaultLevels[compress_method]
+        self.level = level
+
+        # If True, write bundles in the columnar layout, with coverage vectors and length distributions compressed separately
+        self.columnar = columnar
+
         if self.compressMethod == 0:
             self.zlib = __import__('zlib')
         elif self.compressMethod == 1:
@@ -30,16 +99,46 @@ class Compressor:
             print('Set fragment length cutoff to %d' % frag_len_cutoff)
         self.frag_len_cutoff = frag_len_cutoff
 
-    def compress(self, samFilename, compressedFilename, gtf, min_filename, frag_len_z_cutoff, split_diff_strands, split_discordant):
+        # Number of processes used to compute and compress bundles
+        self.num_threads = num_threads
+
+    def compress(self, samFilename, compressedFilename, gtf, min_filename, frag_len_z_cutoff, split_diff_strands, split_discordant, single_pass=False):
         ''' Compresses the alignments to 2 files, one for unspliced and one for spliced
 
             file_prefix: Prefix for all output file names
+            single_pass: If True, read the SAM file only once, determining the fragment length cutoff and pairing as it is compressed.
+                         Mates on different strands are then always unpaired as they are found, as the three-pass Preprocessor does
         '''
 
-        self.p = preprocess.Preprocessor(samFilename, frag_len_z_cutoff, split_diff_strands)
+        if samFilename == '-' or self.isBAMFile(samFilename):
+            # Standard input and BAM files are only read once
+            single_pass = True
+
+        if not single_pass:
+            self.p = preprocess.Preprocessor(samFilename, frag_len_z_cutoff, split_diff_strands)
+
+            if not self.frag_len_cutoff:
+                self.frag_len_cutoff = self.p.frag_len_cutoff
+
+            # Reads on different strands that should be unpaired
+            self.diff_strand_unpaired = self.p.unpaired
+            self.p = None
+
+        filehandle, self.chromosomes, input_alignments = self.openAlignments(samFilename)
+
+        if single_pass:
+            # Fragment lengths are tracked during compression rather than in a separate pass
+            if self.frag_len_cutoff:
+                self.p = preprocess.Preprocessor(None, None, split_diff_strands)
+            else:
+                self.p = preprocess.Preprocessor(None, frag_len_z_cutoff, split_diff_strands)
+                if self.p.find_cutoff:
+                    input_alignments = self.p.estimate_cutoff(input_alignments)
+                    self.frag_len_cutoff = self.p.frag_len_cutoff
+
+            # Mates on different strands are unpaired as they are found
+            self.diff_strand_unpaired = []
 
-        if not self.frag_len_cutoff:
-            self.frag_len_cutoff = self.p.frag_len_cutoff
         print('Using fragment length cutoff of ' + str(self.frag_len_cutoff))
 
         if split_diff_strands:
@@ -52,35 +151,115 @@ class Compressor:
         else:
             print('Not splitting discordant')
 
-        # Reads on different strands that should be unpaired
-        self.diff_strand_unpaired = self.p.unpaired
-        del self.p
-
-        # Read header
-        header = ''
-        with open(samFilename, 'r') as f:
-            for line in f:
-                if line[0] == '@':
-                    header += line
-                else:
-                    break
-        self.chromosomes = self.parseSAMHeader(header)
-        self.aligned = alignments.Alignments(self.chromosomes, self.frag_len_cutoff, split_discordant)
+        # When streaming, mates on different strands are unpaired by Alignments itself, regardless of split_diff_strands
+        unpair_diff_strands_streaming = single_pass
+        self.aligned = alignments.Alignments(self.chromosomes, self.frag_len_cutoff, split_discordant, split_diff_strands=unpair_diff_strands_streaming)
 
         if gtf:
             self.aligned.gtf_exons = self.parseGTF(gtf, self.aligned.chromOffsets)
 
-        self.compressByBundle(samFilename, compressedFilename, min_filename)
+        try:
+            self.compressByBundle(input_alignments, compressedFilename, min_filename)
+        finally:
+            # Make sure no worker processes are left behind if compression fails
+            self.stopPool(True)
+
+        if not filehandle in (sys.stdin, sys.stdin.buffer):
+            filehandle.close()
+
+        if single_pass:
+            if self.p.find_cutoff:
+                print('Final fragment length cutoff: %d' % self.aligned.frag_len_cutoff)
+            if self.aligned.numCrossBundleDiffStrands > 0:
+                print('%d pairs on different strands spanning multiple bundles were kept paired' % self.aligned.numCrossBundleDiffStrands)
 
         #print('%d unmatched' % self.aligned.numUnmatched)
         print('Approximately %d / %d = %f%% of compressed file is coverage' % (self.covSize, self.totalSize, 100.0*float(self.covSize)/float(self.totalSize)))
         print('Finished compressing')
 
-    def compressByBundle(self, input_name, compressed_name, intermediate_name=None):
+    def isBAMFile(self, filename):
+        '''
+        Return True if the given file is a BAM file rather than a SAM file
+        '''
+
+        if filename == '-':
+            return bamIO.isBAM(sys.stdin.buffer)
+
+        with open(filename, 'rb') as f:
+            return bamIO.isBAM(f)
+
+    def openAlignments(self, filename):
         '''
-        Read a sorted SAM file and compress in segments determined by clusters of reads
+        Open a SAM or BAM file for reading and read its header. If filename is '-', read from standard input instead
 
-        :param filename:
+        :return: The open file, the chromosome names and lengths, and an iterator over the alignments in the file
+        '''
+
+        if self.isBAMFile(filename):
+            if filename == '-':
+                filehandle = sys.stdin.buffer
+            else:
+                filehandle = open(filename, 'rb')
+
+            reader = bamIO.BGZFReader(filehandle)
+            header, chromosomes = bamIO.readHeader(reader)
+            return filehandle, chromosomes, bamIO.readAlignments(reader, chromosomes[0])
+
+        if filename == '-':
+            filehandle = sys.stdin
+        else:
+            filehandle = open(filename, 'r')
+
+        header, lines = self.readSAMHeader(filehandle)
+        return filehandle, self.parseSAMHeader(header), self.parseSAMAlignments(lines)
+
+    def readSAMHeader(self, filehandle):
+        '''
+        Read the header lines at the start of a SAM file
+
+        :return: The header and an iterator over the remaining lines in the file
+        '''
+
+        header = ''
+        for line in filehandle:
+            if line[0] == '@':
+                header += line
+            else:
+                return header, itertools.chain([line], filehandle)
+        return header, filehandle
+
+    def parseSAMAlignments(self, lines):
+        '''
+        Parse the alignments in a SAM file
+
+        :param lines: Iterator over the lines in the SAM file
+        :return: Generator over tuples (name, flags, chrom, pos, exons, strand, NH, mate_chrom, mate_pos) for each alignment
+        '''
+
+        for line in lines:
+            # Check if header line
+            if line[0] == '@':
+                continue
+
+            row = samIO.splitRow(line)
+            pos = int(row[3])
+
+            if row[5] == '*':
+                # HISAT occasionally prints * as the cigar string when it is identical to its mate
+                exons = None
+            else:
+                exons = samIO.parseCigar(row[5], pos)
+
+            # find XS (strand) and NH values
+            strand, NH = samIO.parseTags(row[11])
+
+            yield row[0], int(row[1]), row[2], pos, exons, strand, NH, row[6], int(row[7])
+
+    def compressByBundle(self, input_alignments, compressed_name, intermediate_name=None):
+        '''
+        Read a sorted SAM or BAM file and compress in segments determined by clusters of reads
+
+        :param input_alignments: Iterator over alignments in the form returned by parseSAMAlignments()
         :return:
         '''
 
@@ -101,148 +280,135 @@ class Compressor:
 
         firstR = None
 
-        with open(input_name, 'r') as filehandle:
-            id = 0
-            start_id = 0
-            for line in filehandle:
-                # Check if header line
-                if line[0] == '@':
-                    continue
-
-                row = line.strip().split('\t')
-
-                if row[2] == '*':
-                    # HISAT includes unmapped reads at the end of the file; we just skip them
-                    continue
-                if not row[2] in self.chromosomes[0]:
-                    print('Error! Chromosome ' + str(row[2]) + ' not found!')
-                    exit()
-
-                # Starting position of this read
-                start = self.aligned.chromOffsets[row[2]] + int(row[3])
-
-                if self.aligned.gene_bounds and start > (self.aligned.gene_bounds[-1] + overlapRadius):
-                    # Compress most recent bundle
-                    self.aligned.finalizeExons()
-                    self.aligned.finalizeUnmatched()
-                    self.aligned.finalize_cross_bundle_reads()
-                    #if self.aligned.gene_bounds[0] < 100480943 and self.aligned.gene_bounds[1] > 100478955:
-                    #    print(bundle_id)
-                    #    print(self.aligned.gene_bounds)
-                    #    print(self.aligned.exons)
-                    #    print(self.aligned.gene_bounds[0] - self.aligned.chromOffsets['X'])
-                    #    print(self.aligned.gene_bounds[1] - self.aligned.chromOffsets['X'])
-                    #    exit()
-                    bundle_id += 1
-
-                    start_id = id
-
-                    bundles.append(self.aligned.exons)
-
-                    # Write to intermediate file
-                    if intermediate_name:
-                        if first:
-                            # If it's the first bundle, write the header as well
-                            with open(intermediate_name, 'w') as f1:
-                                read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, True, False, read_id)
-                        else:
-                            with open(intermediate_name, 'a') as f1:
-                                read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, False, False, read_id)
-
-                    junctions, maxReadLen = self.aligned.computeBuckets()
-                    self.sortedJuncs = sorted(junctions.keys())
-
-                    # Compress bundle to temporary file
+        # Bundles are compressed in order directly to the output file, optionally by a pool of worker processes
+        out = open(compressed_name, 'wb')
+        self.pending = collections.deque()
+        self.pool = None
+        self.zdict = None
+        if self.compressMethod == 0 and self.dictSizes:
+            # The first bundles are held until there are enough to build a preset dictionary
+            self.samples = []
+            self.sampleSize = 0
+        else:
+            self.samples = None
+        # Bundles being encoded by the worker processes while the preset dictionary is sampled
+        self.sampling = collections.deque()
+        self.startPool()
+
+        id = 0
+        start_id = 0
+        for name, flags, chrom, pos, exons, strand, NH, mate_chrom, mate_pos in input_alignments:
+            if self.p:
+                # Preprocess the alignment in the same pass
+                self.p.process_alignment(chrom, pos, mate_chrom, mate_pos)
+
+            if chrom == '*':
+                # HISAT includes unmapped reads at the end of the file; we just skip them
+                continue
+            if not chrom in self.aligned.chromOffsets:
+                print('Error! Chromosome ' + str(chrom) + ' not found!')
+                exit()
+
+            # Starting position of this read
+            start = self.aligned.chromOffsets[chrom] + pos
+
+            if self.aligned.gene_bounds and start > (self.aligned.gene_bounds[-1] + overlapRadius):
+                # Compress most recent bundle
+                self.aligned.finalizeExons()
+                self.aligned.finalizeUnmatched()
+                self.aligned.finalize_cross_bundle_reads()
+                #if self.aligned.gene_bounds[0] < 100480943 and self.aligned.gene_bounds[1] > 100478955:
+                #    print(bundle_id)
+                #    print(self.aligned.gene_bounds)
+                #    print(self.aligned.exons)
+                #    print(self.aligned.gene_bounds[0] - self.aligned.chromOffsets['X'])
+                #    print(self.aligned.gene_bounds[1] - self.aligned.chromOffsets['X'])
+                #    exit()
+                bundle_id += 1
+
+                start_id = id
+
+                bundles.append(self.aligned.exons)
+
+                # Write to intermediate file
+                if intermediate_name:
                     if first:
-                        mode = 'wb'
+                        # If it's the first bundle, write the header as well
+                        with open(intermediate_name, 'w') as f1:
+                            read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, True, False, read_id)
                     else:
-                        mode = 'ab'
-                    with open('temp.bin', mode) as f:
-                        l = self.compressBundle(junctions, maxReadLen, f)
-                        spliced_index.append(l)
-
-                    # Start new bundle
-                    self.aligned.resetBundle()
-                    self.aligned.exons.add(start)
-
-                    first = False
-
-                # Process read
-                if row[5] == '*':
-                    # HISAT occasionally prints * as the cigar string when it is identical to its mate
-                    #print('No cigar string')
-                    #print(row[0])
-                    #exit()
-                    exons = None
-                else:
-                    exons = self.parseCigar(row[5], int(row[3]))
-
-                # find XS (strand) and NH values
-                strand = None
-                NH = 1
-                for r in row[11 : len(row)]:
-                    if r[0:5] == 'XS:A:' or r[0:5] == 'XS:a:':
-                        strand = r[5]
-                    elif r[0:3] == 'NH:':
-                        NH = int(r[5:])
-
-                flags = int(row[1])
-                if flags & 4:
-                    # Read is unmapped
-                    continue
-
-                r = read.Read(row[2], int(row[3]), exons, strand, NH)
-                #r.name = row[0]
-
-                if row[6] == '*' or (flags & 8):
-                    paired = False
-                elif diff_strand_unpaired_id < num_diff_strand_unpaired and id == self.diff_strand_unpaired[diff_strand_unpaired_id]:
-                    #if not row[6] == '*':
-                    #    print('\t'.join(row))
-                    paired = False
-                    diff_strand_unpaired_id += 1
-                else:
-                    paired = True
-                    r.bundle = bundle_id
-                    r.pairOffset = int(row[7])
-                    if row[6] == '=':
-                        r.pairChrom = row[2]
-                    else:
-                        r.pairChrom = row[6]
-                self.aligned.processRead(row[0], r, paired)
-
-                id += 1
-
-            # Compress final cluster
-            self.aligned.finalizeExons()
-            self.aligned.finalizeUnmatched()
-            self.aligned.finalize_cross_bundle_reads()
-            bundle_id += 1
-
-            bundles.append(self.aligned.exons)
-
-            # Write to intermediate file
-            if intermediate_name:
-                if first:
-                    # If it's the first bundle, write the header as well
-                    with open(intermediate_name, 'w') as f1:
-                        read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, True, False, read_id)
-                    first = False
+                        with open(intermediate_name, 'a') as f1:
+                            read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, False, False, read_id)
+
+                # Compress bundle to output file
+                self.queueBundle(out, spliced_index)
+
+                if self.p and self.p.update_cutoff():
+                    self.aligned.frag_len_cutoff = self.p.frag_len_cutoff
+
+                # Start new bundle
+                self.aligned.resetBundle()
+                self.aligned.exons.add(start)
+
+                first = False
+
+            # Process read
+            if flags & 4:
+                # Read is unmapped
+                continue
+
+            r = read.Read(chrom, pos, exons, strand, NH)
+            #r.name = name
+
+            if mate_chrom == '*' or (flags & 8):
+                paired = False
+            elif diff_strand_unpaired_id < num_diff_strand_unpaired and id == self.diff_strand_unpaired[diff_strand_unpaired_id]:
+                #if not row[6] == '*':
+                #    print('\t'.join(row))
+                paired = False
+                diff_strand_unpaired_id += 1
+            else:
+                paired = True
+                r.bundle = bundle_id
+                r.pairOffset = mate_pos
+                if mate_chrom == '=':
+                    r.pairChrom = chrom
                 else:
-                    with open(intermediate_name, 'a') as f1:
-                        read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, False, False, read_id)
+                    r.pairChrom = mate_chrom
+            self.aligned.processRead(name, r, paired)
 
-            junctions, maxReadLen = self.aligned.computeBuckets()
-            self.sortedJuncs = sorted(junctions.keys())
+            id += 1
+
+        # Compress final cluster
+        self.aligned.finalizeExons()
+        self.aligned.finalizeUnmatched()
+        self.aligned.finalize_cross_bundle_reads()
+        bundle_id += 1
+
+        bundles.append(self.aligned.exons)
 
-            # Compress bundle to temporary file
+        # Write to intermediate file
+        if intermediate_name:
             if first:
-                mode = 'wb'
+                # If it's the first bundle, write the header as well
+                with open(intermediate_name, 'w') as f1:
+                    read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, True, False, read_id)
+                first = False
             else:
-                mode = 'ab'
-            with open('temp.bin', mode) as f:
-                l = self.compressBundle(junctions, maxReadLen, f)
-                spliced_index.append(l)
+                with open(intermediate_name, 'a') as f1:
+                    read_id = self.aligned.writeSAM(f1, self.aligned.unpaired, self.aligned.paired, False, False, read_id)
+
+        # Compress bundle to output file
+        self.queueBundle(out, spliced_index)
+
+        if not self.samples == None:
+            self.finishSampling(out, spliced_index)
+
+        # Write any bundles still being compressed by the worker processes
+        while self.pending:
+            self.writeBundle(out, self.pending.popleft().get(), spliced_index)
+
+        self.stopPool()
 
         leftovers = 0
         for k,v in self.aligned.cross_bundle_reads.items():
@@ -258,53 +424,216 @@ class Compressor:
         print('Maximum bundle length: %d' % max(bundle_lens))
         print('Average bundle length: %d'% (sum(bundle_lens) / len(bundle_lens)))
 
-        # Write index information and append spliced and unspliced files
-        with open(compressed_name, 'wb') as f:
-            s = binaryIO.writeChroms(self.chromosomes)
-            s += binaryIO.writeClusters(bundles)
-            s += binaryIO.writeList(spliced_index)
-            f.write(s)
+        # Compress bundle-spanning buckets after the bundles
+        cross_bundle_start = out.tell()
+        self.compressCrossBundle(self.aligned.cross_bundle_buckets, self.aligned.max_cross_bundle_read_len, bundle_id, out)
+
+        # Write index information as a footer, located by the trailer at the end of the file
+        footer_start = out.tell()
+        s = binaryIO.writePresetDict(self.zdict)
+        s += binaryIO.writeChroms(self.chromosomes)
+        s += binaryIO.writeClusters(bundles)
+        s += binaryIO.writeList(spliced_index)
+        out.write(s)
+        binaryIO.writeTrailer(out, self.compressMethod, cross_bundle_start, footer_start)
+
+        out.close()
+
+
+    def queueBundle(self, filehandle, spliced_index):
+        '''
+        Compress the current bundle, either directly or by handing it to a worker process.
+        Compressed bundles are always written to the file in the order they were queued.
+        '''
+
+        if not self.samples == None:
+            # Hold the encoded bundle until the preset dictionary is built
+            if not self.pool:
+                junctions, maxReadLen = self.aligned.computeBuckets()
+                self.addSample(filehandle, self.encodeBundle(junctions, maxReadLen), spliced_index)
+                return
+
+            self.sampling.append(self.pool.apply_async(encodeBundleWorker, (self.aligned.exons, self.aligned.unpaired, self.aligned.paired)))
+            while len(self.sampling) > 2 * self.num_threads:
+                self.addSample(filehandle, self.sampling.popleft().get(), spliced_index)
+            return
+
+        if not self.pool:
+            junctions, maxReadLen = self.aligned.computeBuckets()
+            self.writeBundle(filehandle, self.compressBundle(self.encodeBundle(junctions, maxReadLen)), spliced_index)
+            return
+
+        self.pending.append(self.pool.apply_async(compressBundleWorker, (self.aligned.exons, self.aligned.unpaired, self.aligned.paired)))
+
+        # Limit the number of bundles held in memory while waiting for workers
+        while len(self.pending) > 2 * self.num_threads:
+            self.writeBundle(filehandle, self.pending.popleft().get(), spliced_index)
+
+    def startPool(self):
+        '''
+        Start the worker processes, if any. Until the preset dictionary is known, they only encode bundles
+        '''
+
+        if self.num_threads > 1:
+            self.pool = multiprocessing.Pool(self.num_threads, initBundleWorker, (self.chromosomes, self.compressMethod, self.level, self.columnar, self.zdict))
+
+    def stopPool(self, terminate=False):
+        '''
+        Shut down the worker processes, if any. If terminate is True, any bundles they are still compressing are discarded
+        '''
+
+        if self.pool:
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def addSample(self, filehandle, encoded, spliced_index):
+        '''
+        Hold an encoded bundle for the preset dictionary, building the dictionary once enough bundles have been sampled
+        '''
+
+        self.samples.append(encoded)
+        self.sampleSize += sum(len(stream) for stream in encoded[0])
+        if self.sampleSize >= self.dictSampleSize:
+            self.finishSampling(filehandle, spliced_index)
+
+    def finishSampling(self, filehandle, spliced_index):
+        '''
+        Build the preset dictionary from the bundles held so far, then compress and write them
+        along with any bundles the worker processes have encoded past the end of the sample
+        '''
+
+        samples = self.samples
+        extra = []
+        while self.sampling:
+            encoded = self.sampling.popleft().get()
+            if self.sampleSize < self.dictSampleSize:
+                samples.append(encoded)
+                self.sampleSize += sum(len(stream) for stream in encoded[0])
+            else:
+                extra.append(encoded)
+        self.samples = None
+
+        self.zdict = self.trainDictionary([stream for encoded in samples for stream in encoded[0]])
+        if self.zdict:
+            print('Using a %d byte preset dictionary' % len(self.zdict))
+
+        if not self.pool:
+            for encoded in samples:
+                self.writeBundle(filehandle, self.compressBundle(encoded), spliced_index)
+            return
+
+        # Restart the workers so that they compress with the preset dictionary
+        self.stopPool()
+        self.startPool()
+        for encoded in samples + extra:
+            self.pending.append(self.pool.apply_async(compressEncodedWorker, (encoded,)))
+
+    def trainDictionary(self, samples):
+        '''
+        Build a zlib preset dictionary from the substrings that occur in the most encoded bundles, trying each size in dictSizes.
+        Returns the dictionary that results in the smallest file, or None if no dictionary saves more space than it takes up
+        '''
+
+        n = self.dictGramLen
+        counts = collections.Counter()
+        for s in samples:
+            # Count each substring once per bundle, in a deterministic order so that ties are broken the same way every run
+            counts.update(dict.fromkeys(s[i:i+n] for i in range(len(s)-n+1)).keys())
+
+        grams = []
+        for gram, count in counts.most_common(max(self.dictSizes) // n):
+            if count < 2:
+                break
+            grams.append(gram)
+
+        self.zdict = None
+        best_dict = None
+        best_size = sum(len(self.compressString(s)) for s in samples)
+
+        num_grams = 0
+        for size in sorted(self.dictSizes):
+            if num_grams == min(size // n, len(grams)):
+                # Same dictionary as the last size
+                continue
+            num_grams = min(size // n, len(grams))
+
+            # zlib encodes nearby matches most cheaply, so the most common substrings go at the end
+            self.zdict = b''.join(reversed(grams[:num_grams]))
+            total_size = sum(len(self.compressString(s)) for s in samples) + len(binaryIO.writePresetDict(self.zdict))
+            if total_size < best_size:
+                best_dict = self.zdict
+                best_size = total_size
+
+        self.zdict = None
+        return best_dict
+
+    def writeBundle(self, filehandle, encoded, spliced_index):
+        '''
+        Write a bundle returned by compressBundle() and record its length in the index
+        '''
+
+        cluster, covSize, totalSize = encoded
+        self.covSize += covSize
+        self.totalSize += totalSize
+
+        filehandle.write(cluster)
+        spliced_index.append(len(cluster))
 
-            # Compress bundle-spanning buckets
-            self.compressCrossBundle(self.aligned.cross_bundle_buckets, self.aligned.max_cross_bundle_read_len, bundle_id, f)
+    def compressBundle(self, encoded):
+        '''
+        Compress a bundle returned by encodeBundle()
+        '''
 
-            # Move contents of temporary file to output file
-            with open('temp.bin', 'rb') as f2:
-                f.write(f2.read())
+        streams, covSize, totalSize = encoded
+        return binaryIO.writeBundleBlock([self.compressString(s) for s in streams]), covSize, totalSize
 
-        os.remove('temp.bin')
+    def encodeBundle(self, junctions, maxReadLen):
+        '''
+        Encode the buckets in a bundle.
+        Returns the list of streams to compress (one in the row layout, two in the columnar layout), the size of the coverage vectors and the total size before compression
+        '''
 
+        self.sortedJuncs = sorted(junctions.keys())
 
-    def compressBundle(self, junctions, maxReadLen, filehandle):
         # Determine the number of bytes for read lengths
         readLenBytes = binaryIO.findNumBytes(maxReadLen)
-        cluster = binaryIO.valToBinary(1, readLenBytes)
-        cluster += binaryIO.writeJunctionsList(self.sortedJuncs, 2)
+        cluster = binaryIO.BinaryWriter()
+        cluster.writeVal(1, readLenBytes)
+        cluster.write(binaryIO.writeJunctionsList(self.sortedJuncs, 2))
+
+        covSize = 0
+        totalSize = len(cluster)
 
-        self.totalSize += len(cluster)
+        if self.columnar:
+            lens = binaryIO.BinaryWriter()
+            for j in self.sortedJuncs:
+                s = binaryIO.writeCov(binaryIO.RLEFromChanges(junctions[j].covChanges, junctions[j].length))
+                covSize += len(s)
+                cluster.write(s)
+                lens.write(binaryIO.writeJunctionLens(readLenBytes, junctions[j]))
+            totalSize = len(cluster) + len(lens)
+
+            return [cluster.getValue(), lens.getValue()], covSize, totalSize
 
         # TODO: No need for junc_lens?
         junc_lens = []
-        junc_string = b''
         for j in self.sortedJuncs:
             #if self.aligned.exons[0] == 100476370 and j == [2, None, 1]:
             #    
 
             s, c, t = binaryIO.writeJunction(readLenBytes, junctions[j])
-            self.covSize += c
-            self.totalSize += t
+            covSize += c
+            totalSize += t
             junc_lens.append(len(s))
-            junc_string += s
-
-        #cluster += binaryIO.writeList(junc_lens)
-        cluster += junc_string
+            cluster.write(s)
 
-        # Write to file
-        start = filehandle.tell()
-        filehandle.write(self.compressString(cluster))
+        #cluster.write(binaryIO.writeList(junc_lens))
 
-        # return length of cluster in file
-        return filehandle.tell() - start
+        return [cluster.getValue()], covSize, totalSize
 
     def compressCrossBundle(self, cross_bundle_buckets, maxReadLen, num_bundles, filehandle):
         '''
@@ -325,87 +654,68 @@ class Compressor:
             num_chunks = math.ceil(len(buckets_sorted) / chunk_size)
             chunk_lens = [0] * num_chunks
 
-            index = binaryIO.valToBinary(4, len(buckets_sorted))
-            index += binaryIO.valToBinary(2, chunk_size)
-            index += binaryIO.valToBinary(1, readLenBytes)
-            index += binaryIO.writeCrossBundleBucketNames(bundleIdBytes, cross_bundle_buckets, buckets_sorted)
+            index = binaryIO.BinaryWriter()
+            index.writeVal(4, len(buckets_sorted))
+            index.writeVal(2, chunk_size)
+            index.writeVal(1, readLenBytes)
 
-            self.totalSize += len(index)
+            # Ids of the chunks containing a bucket that touches each bundle, so that queries only expand those chunks
+            bundle_chunks = [[] for _ in range(num_bundles)]
 
-            main = b''
-            chunk = b''
+            # Compressed chunks, joined once all buckets have been written
+            main = []
+            chunk = binaryIO.BinaryWriter()
             chunk_id = 0
             for i in range(len(buckets_sorted)):
                 b = buckets_sorted[i]
+                bucket = cross_bundle_buckets[b]
+
+                for bundle in (bucket.bundleA, bucket.bundleB):
+                    if not bundle_chunks[bundle] or bundle_chunks[bundle][-1] < chunk_id:
+                        bundle_chunks[bundle].append(chunk_id)
 
-                ch, c, t = binaryIO.writeCrossBundleBucket(readLenBytes, cross_bundle_buckets[b])
-                chunk += ch
+                name = binaryIO.writeCrossBundleBucketName(bundleIdBytes, bucket)
+                ch, c, t = binaryIO.writeCrossBundleBucket(readLenBytes, bucket)
+                chunk.write(name)
+                chunk.write(ch)
                 self.covSize += c
-                self.totalSize += t
+                self.totalSize += len(name) + t
                 if (i+1) % chunk_size == 0:
-                    compressed = self.compressString(chunk)
+                    compressed = self.compressString(chunk.getValue())
                     chunk_lens[chunk_id] = len(compressed)
                     chunk_id += 1
-                    main += compressed
-                    chunk = b''
+                    main.append(compressed)
+                    chunk = binaryIO.BinaryWriter()
 
             if len(chunk) > 0:
-                compressed = self.compressString(chunk)
+                compressed = self.compressString(chunk.getValue())
                 chunk_lens[chunk_id] = len(compressed)
-                main += compressed
+                main.append(compressed)
 
-            index += binaryIO.writeList(chunk_lens)
+            index.write(binaryIO.writeList(chunk_lens))
 
-            index = self.compressString(index)
+            # Chunk ids for each bundle, as a single list with the position where each bundle's ids begin
+            chunk_starts = [0] * (num_bundles+1)
+            for i in range(num_bundles):
+                chunk_starts[i+1] = chunk_starts[i] + len(bundle_chunks[i])
+            index.write(binaryIO.writeList(chunk_starts))
+            index.write(binaryIO.writeList([c for chunks in bundle_chunks for c in chunks]))
+
+            self.totalSize += len(index)
+
+            index = self.compressString(index.getValue())
             length = len(index)
             numBytes = binaryIO.findNumBytes(length)
             binaryIO.writeVal(filehandle, 1, numBytes)
             binaryIO.writeVal(filehandle, numBytes, length)
             filehandle.write(index)
-            filehandle.write(main)
+            filehandle.write(b''.join(main))
 
             print('Compressed size: %d' % (filehandle.tell() - pos))
         else:
             binaryIO.writeVal(filehandle, 1, 1)
             binaryIO.writeVal(filehandle, 1, 0)
 
-    def parseCigar(self, cigar, offset):
-        ''' Parse the cigar string starting at the given index of the genome
-            Returns a list of offsets for each exonic region of the read [(start1, end1), (start2, end2), ...]
-        '''
-
-        exons = []
-        newExon = True
-
-        # Parse cigar string
-        match = re.search("\D", cigar)
-        while match:
-            index = match.start()
-            length = int(''.join(cigar[:index]))
-
-            if cigar[index] == 'N':
-                # Separates contiguous exons, so set boolean to start a new one
-                newExon = True
-            elif cigar[index] == 'M':
-                # If in the middle of a contiguous exon, append the length to it, otherwise start a new exon
-                if newExon:
-                    exons.append([offset, offset+length])
-                    newExon = False
-                else:
-                    exons[-1][1] += length
-            elif cigar[index] == 'D':
-                # If in the middle of a contiguous exon, append the deleted length to it
-                if not newExon:
-                    exons[-1][1] += length
-
-            # Skip soft clipping
-            if not cigar[index] == 'S':
-                offset += length
-            cigar = cigar[index+1:]
-            match = re.search("\D", cigar)
-
-        return exons
-
     def parseSAMHeader(self, header):
         # In the order they appear in the header
         chromNames = []
@@ -434,8 +744,12 @@ class Compressor:
             Return the compressed string '''
 
         if self.compressMethod == 0:
-            return self.zlib.compress(s)
+            if self.zdict:
+                # Blocks that share a preset dictionary are stored as raw deflate streams, without the zlib header
+                c = self.zlib.compressobj(self.level, self.zlib.DEFLATED, -15, zdict=self.zdict)
+                return c.compress(s) + c.flush()
+            return self.zlib.compress(s, self.level)
         elif self.compressMethod == 1:
-            return self.lzma.compress(s)
+            return self.lzma.compress(s, preset=self.level)
         elif self.compressMethod == 2:
-            return self.bz2.compress(s)
+            return self.bz2.compress(s, self.level)
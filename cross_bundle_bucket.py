@@ -1,3 +1,5 @@
+import bucket
+
 class CrossBundleBucket:
     ''' A bucket spanning two bundles '''
 
@@ -16,7 +18,9 @@ class CrossBundleBucket:
 
     def set_length(self, length):
         self.length = length
-        self.coverage = [[0, self.length]]
+
+        # Coverage vector stored as the change in coverage at each offset where it changes
+        self.covChanges = dict()
 
     def add_pair(self, readA, readB):
         length = self.length - readA.startOffset - readB.endOffset
@@ -47,25 +51,7 @@ class CrossBundleBucket:
             self.pairedLens[length] = 1
 
     def updateCov(self, start, length):
-        i = 0
-
-        while start >= self.coverage[i][1]:
-            start -= self.coverage[i][1]
-            i += 1
-
-        if start > 0:
-            self.coverage = self.coverage[:i] + [ [self.coverage[i][0], start], [self.coverage[i][0], self.coverage[i][1]-start] ] + self.coverage[i+1:]
-            i += 1
-
-        rle_len = len(self.coverage)
-
-        while i < rle_len and length >= self.coverage[i][1]:
-            self.coverage[i][0] += 1
-            if self.coverage[i][0] < 0:
-                self.coverage[i][0] = 0
-
-            length -= self.coverage[i][1]
-            i += 1
+        ''' Add a read covering [start, start+length) to the coverage vector
+        '''
 
-        if i < rle_len and length > 0:
-            self.coverage = self.coverage[:i] + [ [max(self.coverage[i][0]+1,0), length], [self.coverage[i][0], self.coverage[i][1]-length] ] + self.coverage[i+1:]
+        bucket.addCoverage(self.covChanges, start, length)
@@ -3,8 +3,40 @@ import read
 import pairedread
 import bucket
 import time
+import sys
 import binaryIO
+import bundleIndex
+import bamIO
 import bisect
+import collections
+import io
+import multiprocessing
+
+# Per-process state for bundle expansion workers, set by initBundleWorker()
+worker_expander = None
+
+def initBundleWorker(chromosomes, compress_method, zdict, version):
+    ''' Initialize a worker process to expand bundles
+    '''
+    global worker_expander
+
+    worker_expander = Expander()
+    worker_expander.setCompressMethod(compress_method, zdict)
+    worker_expander.formatVersion = version
+    worker_expander.aligned = alignments.Alignments(chromosomes)
+
+def expandBundleWorker(exons, block):
+    ''' Reconstruct the reads in a bundle from its compressed block in a worker process.
+        Returns the unpaired and paired reads
+    '''
+
+    aligned = worker_expander.aligned
+    aligned.exons = exons
+    aligned.unpaired = []
+    aligned.paired = []
+
+    worker_expander.expandCluster(io.BytesIO(block), len(block), False)
+    return aligned.unpaired, aligned.paired
 
 class Expander:
     aligned = None
@@ -15,14 +47,12 @@ class Expander:
     # 2 - bz2
     compressMethod = 0
 
-    def __init__(self, force_xs=False):
+    # Size in bytes of the buffer used when writing decompressed alignments to a file
+    outputBufferSize = 1 << 20
+
+    def __init__(self, force_xs=False, num_threads=1, bam=False, sort=False):
         self.debug = False
-        if self.compressMethod == 0:
-            self.zlib = __import__('zlib')
-        elif self.compressMethod == 1:
-            self.lzma = __import__('lzma')
-        elif self.compressMethod == 2:
-            self.bz2 = __import__('bz2')
+        self.setCompressMethod(self.compressMethod)
 
         self.readCounts = []
         self.readTimes = []
@@ -32,36 +62,131 @@ class Expander:
         self.pairTimesB = []
 
         self.force_xs = force_xs
+        self.num_threads = num_threads
+        self.bam = bam
+        self.sort = sort
 
         self.read_time = 0.0
         self.pair_time = 0.0
         self.assign_time = 0.0
 
 
-    def expand(self, compressedFilename, uncompressedFilename):
+    def setCompressMethod(self, compress_method, zdict=None):
+        ''' Load the library for the codec recorded in a compressed file, along with its preset dictionary
+        '''
+
+        self.compressMethod = compress_method
+        self.zdict = zdict
+        if self.compressMethod == 0:
+            self.zlib = __import__('zlib')
+        elif self.compressMethod == 1:
+            self.lzma = __import__('lzma')
+        elif self.compressMethod == 2:
+            self.bz2 = __import__('bz2')
+        else:
+            print('Error! Unrecognized compression method %d' % compress_method)
+            exit()
+
+    def expand(self, compressedFilename, uncompressed):
         ''' Expand both spliced and unspliced alignments
+
+        :param uncompressed: Filename to write the SAM (or BAM, if self.bam is True) output to, '-' for standard output, or a file object opened for writing text (or bytes)
         '''
 
         self.aligned = None
 
-        with open(compressedFilename, 'rb') as f:
+        # The output is opened once for the whole run, and only closed here if it was opened here
+        opened = False
+        if uncompressed == '-':
+            if self.bam:
+                out = sys.stdout.buffer
+            else:
+                out = sys.stdout
+        elif hasattr(uncompressed, 'write'):
+            out = uncompressed
+        elif self.bam:
+            out = open(uncompressed, 'wb', buffering=self.outputBufferSize)
+            opened = True
+        else:
+            out = open(uncompressed, 'w', buffering=self.outputBufferSize)
+            opened = True
+
+        # BAM records are compressed into BGZF blocks before reaching the output
+        if self.bam:
+            self.writer = bamIO.BGZFWriter(out)
+
+        with binaryIO.MappedReader(compressedFilename) as f:
+            compress_method, zdict, self.cross_bundle_start, self.formatVersion = binaryIO.seekFooter(f)
+            self.setCompressMethod(compress_method, zdict)
             chroms = binaryIO.readChroms(f)
             self.aligned = alignments.Alignments(chroms)
 
-            self.expandByCluster(f, uncompressedFilename)
+            # Bundles are expanded in order, optionally by a pool of worker processes, and their reads are written from this process
+            self.pool = None
+            if self.num_threads > 1:
+                self.pool = multiprocessing.Pool(self.num_threads, initBundleWorker, (chroms, compress_method, zdict, self.formatVersion))
+
+            try:
+                self.expandByCluster(f, out)
+                self.stopPool()
+            finally:
+                # Make sure no worker processes are left behind if expansion fails
+                self.stopPool(True)
+
+        if self.bam:
+            self.writer.close()
+
+        if opened:
+            out.close()
+        else:
+            out.flush()
+
+    def stopPool(self, terminate=False):
+        '''
+        Shut down the worker processes, if any. If terminate is True, any bundles they are still expanding are discarded
+        '''
 
-    def expandByCluster(self, f, out_name):
+        if self.pool:
+            if terminate:
+                self.pool.terminate()
+            else:
+                self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def expandByCluster(self, f, out):
         t1 = time.time()
-        self.bundles = binaryIO.readClusters(f)
+        self.bundles = binaryIO.readClusters(f, self.formatVersion)
         spliced_index = binaryIO.readListFromFile(f)
         t2 = time.time()
         
+        f.seek(self.cross_bundle_start)
         self.expandCrossBundleBuckets(f)
         t3 = time.time()
 
-        readId = 0
+        # Bundles begin at the start of the file
+        f.seek(0)
+
+        self.readId = 0
+        self.bundlesWritten = 0
+        pending = collections.deque()
+
+        if self.sort:
+            # Reads from cross-bundle buckets span several bundles, so they are held in order of position and merged into the records of each bundle
+            self.writeHeader(out)
+            self.crossRecords = collections.deque(self.sortedRecords(self.aligned.unpaired, self.aligned.paired))
+            self.aligned.unpaired = []
+            self.aligned.paired = []
 
         for i in range(len(self.bundles)):
+            if self.pool:
+                pending.append(self.pool.apply_async(expandBundleWorker, (self.bundles[i], bytes(f.read(spliced_index[i])))))
+
+                # Limit the number of bundles held in memory while waiting for workers
+                while len(pending) > 2 * self.num_threads:
+                    self.writeBundle(out, pending.popleft().get())
+                continue
+
             self.aligned.exons = self.bundles[i]
 
             #print('Expanding cluster')
@@ -70,16 +195,13 @@ class Expander:
             #    debug = True
             #    print(self.aligned.exons)
             self.expandCluster(f, spliced_index[i], debug)
+            self.writeBundle(out)
 
-            if i == 0:
-                with open(out_name, 'w') as f2:
-                    readId = self.aligned.writeSAM(f2, self.aligned.unpaired, self.aligned.paired, True, self.force_xs, readId)
-            else:
-                with open(out_name, 'a') as f2:
-                    readId = self.aligned.writeSAM(f2, self.aligned.unpaired, self.aligned.paired, False, self.force_xs, readId)
+        while pending:
+            self.writeBundle(out, pending.popleft().get())
 
-            self.aligned.unpaired = []
-            self.aligned.paired = []
+        if self.sort:
+            self.writeRecords(out, [r[1] for r in self.crossRecords])
         t4 = time.time()
 
         #self.aligned.printTime()
@@ -91,10 +213,76 @@ class Expander:
         #print('  Getting pairs time:      %f s' % self.pair_time)
         #print('  Assigning reads time:    %f s' % self.assign_time)
 
+    def writeBundle(self, out, reads=None):
+        ''' Write the reads expanded from the next bundle to out, given as the unpaired and paired reads returned by a worker process or otherwise held in self.aligned.
+            Reads from cross-bundle buckets are written with the first bundle, following the header
+        '''
+
+        if not reads == None:
+            self.aligned.unpaired += reads[0]
+            self.aligned.paired += reads[1]
+
+        if self.sort:
+            self.writeRecords(out, self.mergeRecords(self.sortedRecords(self.aligned.unpaired, self.aligned.paired)))
+        elif self.bam:
+            self.readId = self.aligned.writeBAM(self.writer, self.aligned.unpaired, self.aligned.paired, self.bundlesWritten == 0, self.force_xs, self.readId)
+        else:
+            self.readId = self.aligned.writeSAM(out, self.aligned.unpaired, self.aligned.paired, self.bundlesWritten == 0, self.force_xs, self.readId)
+        self.bundlesWritten += 1
+
+        self.aligned.unpaired = []
+        self.aligned.paired = []
+
+    def sortedRecords(self, unpaired, paired):
+        ''' Format the given reads as SAM lines or BAM records.
+            Returns a list of (position, record) pairs sorted by position
+        '''
+
+        starts = []
+        if self.bam:
+            records, self.readId = self.aligned.formatBAM(unpaired, paired, self.force_xs, self.readId, starts)
+        else:
+            records, self.readId = self.aligned.formatSAM(unpaired, paired, self.force_xs, self.readId, starts)
+
+        order = sorted(range(len(records)), key=starts.__getitem__)
+        return [(starts[i], records[i]) for i in order]
+
+    def mergeRecords(self, records):
+        ''' Merge the sorted records of a bundle with the held cross-bundle records that start before them.
+            Bundles are disjoint and in order, so the result follows every record written so far
+        '''
+
+        cross = self.crossRecords
+        merged = []
+        for pos, r in records:
+            while cross and cross[0][0] < pos:
+                merged.append(cross.popleft()[1])
+            merged.append(r)
+        return merged
+
+    def writeHeader(self, out):
+        ''' Write the header of a sorted output file
+        '''
+
+        if self.bam:
+            self.writer.write(self.aligned.headerBAM(True))
+        else:
+            out.write(self.aligned.headerText(True))
+
+    def writeRecords(self, out, records):
+        ''' Write a list of SAM lines or BAM records to the output
+        '''
+
+        if self.bam:
+            self.writer.write(b''.join(records))
+        else:
+            out.write(''.join(records))
+
     def expandCluster(self, f, length, debug):
-        cluster = self.expandString(f.read(length))
+        cluster, lens = self.readBundle(f, length)
         readLenBytes, startPos = binaryIO.binaryToVal(cluster, 1, 0)
         sorted_junctions, exonBytes, startPos = binaryIO.readJunctionsList(cluster, startPos)
+        lensPos = 0
 
         for key in sorted_junctions:
             if debug:
@@ -115,7 +303,8 @@ class Expander:
                         boundaries.append(boundaries[-1] + subexon_length)
 
             # Read the rest of the junction information
-            junc, startPos = binaryIO.readJunction(cluster, bucket.Bucket(exons, length, boundaries), readLenBytes, startPos)
+            junc = bucket.Bucket(exons, length, boundaries)
+            startPos, lensPos = self.readBundleBucket(cluster, lens, junc, readLenBytes, startPos, lensPos)
             junc.strand = key[-2]
             junc.NH = key[-1]
 
@@ -128,45 +317,93 @@ class Expander:
             exit()
 
     def expandCrossBundleBuckets(self, filehandle):
+        for b in self.readCrossBundleBuckets(filehandle):
+            b.coverage = self.RLEtoVector(b.coverage)
+
+            exonsA = self.bundles[b.bundleA]
+            exonsB = self.bundles[b.bundleB]
+            exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
+            b.exon_bounds = exon_bounds
+
+            boundaries = [exon_bounds[0][1]-exon_bounds[0][0]]
+            for n in range(1, len(exon_bounds)):
+                boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
+            b.boundaries = boundaries
+
+            self.expandCrossBundleBucket(b, False)
+
+    def readCrossBundleBuckets(self, filehandle, start_i=0, end_i=None):
+        ''' Generator over the cross-bundle buckets, with their coverage and length distributions read.
+            If end_i is given, only buckets that touch a bundle in [start_i, end_i) are returned, and chunks containing none of them are not decompressed.
+            filehandle must be positioned at the start of the cross-bundle section
+        '''
+
         num_bundles = len(self.bundles)
         bundleIdBytes = binaryIO.findNumBytes(num_bundles)
         numBytes = binaryIO.readVal(filehandle, 1)
         length = binaryIO.readVal(filehandle, numBytes)
 
-        if length > 0:
-            index = self.expandString(filehandle.read(length))
-            num_buckets, startPos = binaryIO.binaryToVal(index, 4, start=0)
-            chunk_size, startPos = binaryIO.binaryToVal(index, 2, startPos)
-            readLenBytes, startPos = binaryIO.binaryToVal(index, 1, startPos)
-            buckets, startPos = binaryIO.readCrossBundleBucketNames(index, num_buckets, bundleIdBytes, startPos)
-            chunk_lens, startPos = binaryIO.readList(index, startPos)
+        if length == 0:
+            return
 
-            i = 0
-            for l in chunk_lens:
-                chunk = self.expandString(filehandle.read(l))
-                startPos = 0
+        index = self.expandString(filehandle.read(length))
+        chunksStart = filehandle.tell()
+        num_buckets, startPos = binaryIO.binaryToVal(index, 4, start=0)
+        chunk_size, startPos = binaryIO.binaryToVal(index, 2, startPos)
+        readLenBytes, startPos = binaryIO.binaryToVal(index, 1, startPos)
 
-                for i in range(i, min(i+chunk_size, num_buckets)):
-                    b = buckets[i]
-                    startPos = binaryIO.readCrossBundleBucket(chunk, b, readLenBytes, startPos)
+        if self.formatVersion < 3:
+            # All bucket names are stored in the index, so the relevant chunks are found by checking every bucket
+            buckets, startPos = binaryIO.readCrossBundleBucketNames(index, num_buckets, bundleIdBytes, startPos)
+            chunk_lens, startPos = binaryIO.readList(index, startPos)
+            chunk_ids = range(len(chunk_lens))
+        else:
+            chunk_lens, startPos = binaryIO.readList(index, startPos)
+            chunk_starts, startPos = binaryIO.readList(index, startPos)
+            bundle_chunks, startPos = binaryIO.readList(index, startPos)
+            if end_i == None:
+                chunk_ids = range(len(chunk_lens))
+            else:
+                chunk_ids = sorted(set(bundle_chunks[chunk_starts[start_i]:chunk_starts[end_i]]))
 
-                    b.coverage = self.RLEtoVector(b.coverage)
+        offsets = [0] * (len(chunk_lens)+1)
+        for c in range(len(chunk_lens)):
+            offsets[c+1] = offsets[c] + chunk_lens[c]
 
-                    exonsA = self.bundles[b.bundleA]
-                    exonsB = self.bundles[b.bundleB]
-                    exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
-                    b.exon_bounds = exon_bounds
+        for c in chunk_ids:
+            first = c * chunk_size
+            last = min(first+chunk_size, num_buckets)
 
-                    boundaries = [exon_bounds[0][1]-exon_bounds[0][0]]
-                    for n in range(1, len(exon_bounds)):
-                        boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
-                    b.boundaries = boundaries
+            if self.formatVersion < 3:
+                # Only read up to the last relevant bucket in the chunk
+                relevant = [i for i in range(first, last) if end_i == None or self.touchesBundles(buckets[i], start_i, end_i)]
+                if not relevant:
+                    continue
+                last = relevant[-1] + 1
 
-                    self.expandCrossBundleBucket(b, False)
+            filehandle.seek(chunksStart + offsets[c])
+            chunk = self.expandString(filehandle.read(chunk_lens[c]))
+            startPos = 0
 
+            for i in range(first, last):
+                if self.formatVersion < 3:
+                    b = buckets[i]
                     # Delete this bucket to save space
                     buckets[i] = None
-                i += 1
+                else:
+                    b, startPos = binaryIO.readCrossBundleBucketName(chunk, bundleIdBytes, startPos)
+
+                if end_i == None or self.touchesBundles(b, start_i, end_i):
+                    startPos = binaryIO.readCrossBundleBucket(chunk, b, readLenBytes, startPos, self.formatVersion)
+                    yield b
+                else:
+                    startPos = binaryIO.skipCrossBundleBucket(chunk, readLenBytes, startPos, self.formatVersion)
+
+    def touchesBundles(self, bucket, start_i, end_i):
+        ''' Return True if a cross-bundle bucket spans any bundle in [start_i, end_i)
+        '''
+
+        return (bucket.bundleA >= start_i and bucket.bundleA < end_i) or (bucket.bundleB >= start_i and bucket.bundleB < end_i)
 
     '''
     def expandCluster(self, f, length):
@@ -458,11 +695,54 @@ class Expander:
             vector += [row[0]] * row[1]
         return vector
 
+    def readBundle(self, f, length, withLens=True):
+        ''' Read and decompress the bundle block of the given length at the current position in f.
+            Returns the stream holding the bucket list and coverage vectors, and the stream holding the length distributions.
+            The second stream is None in the row layout, where both are interleaved in the first, and empty if withLens is False
+        '''
+
+        streams = binaryIO.splitBundleBlock(f.read(length), self.formatVersion)
+        bundle = self.expandString(streams[0])
+        if len(streams) == 1:
+            return bundle, None
+        elif not withLens:
+            return bundle, b''
+        else:
+            return bundle, self.expandString(streams[1])
+
+    def readBundleBucket(self, bundle, lens, b, readLenBytes, startPos, lensPos):
+        ''' Read the coverage and length distributions of the next bucket in a bundle returned by readBundle() into b.
+            Returns the positions following the bucket in both streams
+        '''
+
+        if lens == None:
+            b, startPos = binaryIO.readJunction(bundle, b, readLenBytes, startPos, self.formatVersion)
+            return startPos, lensPos
+
+        b.coverage, startPos = binaryIO.readCov(bundle, startPos, self.formatVersion)
+        if lens:
+            lensPos = binaryIO.readJunctionLens(lens, b, readLenBytes, lensPos, self.formatVersion)
+        return startPos, lensPos
+
+    def skipBundleBucket(self, bundle, lens, readLenBytes, startPos, lensPos):
+        ''' Skip the next bucket in a bundle returned by readBundle(). Returns the positions following the bucket in both streams
+        '''
+
+        if lens == None:
+            return binaryIO.skipJunction(bundle, readLenBytes, startPos, self.formatVersion), lensPos
+
+        startPos = binaryIO.skipCov(bundle, startPos, self.formatVersion)
+        if lens:
+            lensPos = binaryIO.skipJunctionLens(lens, readLenBytes, lensPos, self.formatVersion)
+        return startPos, lensPos
+
     def expandString(self, s):
         ''' Use a predefined python library to expand the given string.
             Return the decompressed string '''
 
         if self.compressMethod == 0:
+            if self.zdict:
+                return self.zlib.decompressobj(-15, zdict=self.zdict).decompress(s)
             return self.zlib.decompress(s)
         elif self.compressMethod == 1:
             return self.lzma.decompress(s)
@@ -470,11 +750,13 @@ class Expander:
             return self.bz2.decompress(s)
 
     def getChromosomes(self, compressedFilename):
-        with open(compressedFilename, 'rb') as f:
+        with binaryIO.MappedReader(compressedFilename) as f:
+            binaryIO.seekFooter(f)
             return binaryIO.readChroms(f)
 
     def getGeneBounds(self, compressedFilename, chrom, start=None, end=None):
-        with open(compressedFilename, 'rb') as f:
+        with binaryIO.MappedReader(compressedFilename) as f:
+            _, _, _, self.formatVersion = binaryIO.seekFooter(f)
             chromsList = binaryIO.readChroms(f)
             chromosomes = dict()
             for i in range(len(chromsList[0])):
@@ -493,13 +775,27 @@ class Expander:
             start += offset
             end += offset
 
-            clusters = binaryIO.readClusters(f)
-            start_i, end_i = self.getRelevantClusters(clusters, start, end)
-            return [(c[0]-offset, c[-1]-offset) for c in clusters[start_i:end_i]]
+            bundles = self.loadBundles(f, compressedFilename)
+            start_i, end_i = bundles.getRelevantBundles(start, end)
+            return [(bundles.starts[i]-offset, bundles.ends[i]-offset) for i in range(start_i, end_i)]
+
+    def loadBundles(self, f, compressedFilename):
+        ''' Load the bounds and offsets of the bundles in a compressed file, from its index file if it has an up-to-date one and otherwise from the footer.
+            f must be positioned at the cluster table, following the chromosomes
+        '''
+
+        tableStart = f.tell()
+        bundles = bundleIndex.readIndex(f, compressedFilename, self.formatVersion)
+        if bundles == None:
+            f.seek(tableStart)
+            bundles = bundleIndex.buildIndex(f, self.formatVersion)
+        return bundles
 
     def getCoverage(self, compressedFilename, chrom, start=None, end=None):
         #print('Getting coverage in %s: %d - %d' % (chrom, start, end))
-        with open(compressedFilename, 'rb') as f:
+        with binaryIO.MappedReader(compressedFilename) as f:
+            compress_method, zdict, cross_bundle_start, self.formatVersion = binaryIO.seekFooter(f)
+            self.setCompressMethod(compress_method, zdict)
             chromosomes = binaryIO.readChroms(f)
             self.aligned = alignments.Alignments(chromosomes)
             if start == None:
@@ -516,94 +812,43 @@ class Expander:
 
             coverage = [0.0] * (end-start)
 
-            self.bundles = binaryIO.readClusters(f)
-            start_i, end_i = self.getRelevantClusters(self.bundles, start, end)
+            self.bundles = self.loadBundles(f, compressedFilename)
+            start_i, end_i = self.bundles.getRelevantBundles(start, end)
 
             if start_i >= end_i:
                 return coverage
 
-            spliced_index = binaryIO.readListFromFile(f)
-
             st = time.time()
+            f.seek(cross_bundle_start)
             coverage = self.getAllCrossBucketsCoverage(f, coverage, start_i, end_i, start, end)
             en = time.time()
 
             processT = 0.0
 
-            f.seek(sum(spliced_index[:start_i]), 1)
+            f.seek(self.bundles.offsets[start_i])
             st = time.time()
             for i in range(start_i, end_i):
                 self.aligned.exons = self.bundles[i]
-                coverage, t = self.getBundleCoverage(f, spliced_index[i], coverage, start, end)
+                coverage, t = self.getBundleCoverage(f, self.bundles.getLength(i), coverage, start, end)
                 processT += t
             en = time.time()
 
         return coverage
 
     def getAllCrossBucketsCoverage(self, filehandle, coverage, start_i, end_i, range_start, range_end):
-        num_bundles = len(self.bundles)
-        bundleIdBytes = binaryIO.findNumBytes(num_bundles)
-        numBytes = binaryIO.readVal(filehandle, 1)
-        length = binaryIO.readVal(filehandle, numBytes)
-
-        if length > 0:
-            index = self.expandString(filehandle.read(length))
-            num_buckets, startPos = binaryIO.binaryToVal(index, 4, start=0)
-            chunk_size, startPos = binaryIO.binaryToVal(index, 2, startPos)
-            readLenBytes, startPos = binaryIO.binaryToVal(index, 1, startPos)
-            st = time.time()
-            buckets, startPos = binaryIO.readCrossBundleBucketNames(index, num_buckets, bundleIdBytes, startPos)
-            en = time.time()
-            chunk_lens, startPos = binaryIO.readList(index, startPos)
-
-            curr_bucket = 0
-            skip = 0
-
-            for l in chunk_lens:
-                buckets_in_chunk = min(chunk_size, num_buckets-curr_bucket)
-                relevant = [0] * buckets_in_chunk
-                last_relevant = -1
-
-                for i in range(buckets_in_chunk):
-                    bundleA = buckets[i+curr_bucket].bundleA
-                    bundleB = buckets[i+curr_bucket].bundleB
-                    if (bundleA >= start_i and bundleA < end_i) or (bundleB >= start_i and bundleB < end_i):
-                        relevant[i] = 1
-                        last_relevant = i
-
-                if last_relevant == -1:
-                    skip += l
-                else:
-                    if skip > 0:
-                        filehandle.seek(skip, 1)
-                        skip = 0
-
-                    chunk = self.expandString(filehandle.read(l))
-                    startPos = 0
-
-                    for i in range(last_relevant+1):
-                        if relevant[i]:
-                            b = buckets[i+curr_bucket]
-                            startPos = binaryIO.readCrossBundleBucket(chunk, b, readLenBytes, startPos)
-                            b.coverage = self.RLEtoVector(b.coverage)
-
-                            exonsA = self.bundles[b.bundleA]
-                            exonsB = self.bundles[b.bundleB]
-
-                            # Is this necessary?
-                            exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
-                            boundaries = [0]
-                            for n in range(len(exon_bounds)):
-                                boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
+        for b in self.readCrossBundleBuckets(filehandle, start_i, end_i):
+            b.coverage = self.RLEtoVector(b.coverage)
 
-                            coverage = self.getBucketCoverage(b, coverage, range_start, range_end, exon_bounds, boundaries)
-                        else:
-                            startPos = binaryIO.skipCrossBundleBucket(chunk, readLenBytes, startPos)
+            exonsA = self.bundles[b.bundleA]
+            exonsB = self.bundles[b.bundleB]
 
-                curr_bucket += buckets_in_chunk
+            # Is this necessary?
+            exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
+            boundaries = [0]
+            for n in range(len(exon_bounds)):
+                boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
 
-            if skip > 0:
-                filehandle.seek(skip, 1)
+            coverage = self.getBucketCoverage(b, coverage, range_start, range_end, exon_bounds, boundaries)
 
         return coverage
 
@@ -641,8 +886,10 @@ class Expander:
         return coverage
 
     def getBundleCoverage(self, f, length, coverage, range_start, range_end):
-        bundle = self.expandString(f.read(length))
+        # Length distributions are not needed for coverage
+        bundle, lens = self.readBundle(f, length, False)
         startPos = 0
+        lensPos = 0
         readLenBytes, startPos = binaryIO.binaryToVal(bundle, 1, startPos)
         sorted_buckets, exonBytes, startPos = binaryIO.readJunctionsList(bundle, startPos)
 
@@ -661,7 +908,7 @@ class Expander:
 
             # If the junction does not overlap the target region, skip it
             if not relevant:
-                startPos = binaryIO.skipJunction(bundle, readLenBytes, startPos)
+                startPos, lensPos = self.skipBundleBucket(bundle, lens, readLenBytes, startPos, lensPos)
                 continue
 
             # Otherwise, expand this junction
@@ -680,7 +927,8 @@ class Expander:
                         boundaries.append(boundaries[-1] + subexon_length)
 
             # Read the rest of the junction information
-            junc, startPos = binaryIO.readJunction(bundle, bucket.Bucket(exons, length, boundaries), readLenBytes, startPos)
+            junc = bucket.Bucket(exons, length, boundaries)
+            startPos, lensPos = self.readBundleBucket(bundle, lens, junc, readLenBytes, startPos, lensPos)
             junc.NH = float(key[-1])
             junc.coverage = self.RLEtoVector(junc.coverage)
 
@@ -703,40 +951,15 @@ class Expander:
 
         return coverage, t
 
-    def getRelevantClusters(self, clusters, start, end):
-        '''
-
-        :param clusters:
-        :param start:
-        :param end:
-        :return: The start and end+1 index in clusters of all clusters that overlap [start,end)
-        '''
-
-        cluster_bounds = [(c[0], c[-1]) for c in clusters]
-
-        i = bisect.bisect_left(cluster_bounds, (start,start))
-
-        if cluster_bounds[i-1][0] <= start and cluster_bounds[i-1][1] > start:
-            start_i = i-1
-        elif cluster_bounds[i][1] > start:
-            start_i = i
-        else:
-            print('Error bisecting')
-            print('(%d,%d)' % (start,end))
-            print(cluster_bounds[i-3:i+3])
-            exit()
-
-        end_i = bisect.bisect_left(cluster_bounds, (end,end))
-
-        return start_i, end_i
-
     def getRelevantExons(self, exons, start, end):
         start_i = bisect.bisect_right(exons, start) - 1
         end_i = bisect.bisect_left(exons, end)
         return start_i, end_i
 
     def getReads(self, compressedFilename, chrom, start=None, end=None):
-        with open(compressedFilename, 'rb') as f:
+        with binaryIO.MappedReader(compressedFilename) as f:
+            compress_method, zdict, cross_bundle_start, self.formatVersion = binaryIO.seekFooter(f)
+            self.setCompressMethod(compress_method, zdict)
             chromosomes = binaryIO.readChroms(f)
             self.aligned = alignments.Alignments(chromosomes)
             if start == None:
@@ -751,91 +974,41 @@ class Expander:
             start += self.aligned.chromOffsets[chrom]
             end += self.aligned.chromOffsets[chrom]
 
-            self.bundles = binaryIO.readClusters(f)
-            start_i, end_i = self.getRelevantClusters(self.bundles, start, end)
+            self.bundles = self.loadBundles(f, compressedFilename)
+            start_i, end_i = self.bundles.getRelevantBundles(start, end)
 
             if start_i >= end_i:
                 return []
 
-            spliced_index = binaryIO.readListFromFile(f)
-
+            f.seek(cross_bundle_start)
             unpaired, paired = self.getAllCrossBucketsReads(f, start_i, end_i, start, end)
 
-            f.seek(sum(spliced_index[:start_i]), 1)
+            f.seek(self.bundles.offsets[start_i])
             for i in range(start_i, end_i):
                 self.aligned.exons = self.bundles[i]
                 #print('Bundle %d - %d (%d)' % (bundles[i][0], bundles[i][-1], bundles[i][-1]-bundles[i][0]))
-                self.getBundleReads(f, spliced_index[i], start, end, unpaired, paired)
+                self.getBundleReads(f, self.bundles.getLength(i), start, end, unpaired, paired)
 
         return self.aligned, unpaired, paired
 
     def getAllCrossBucketsReads(self, filehandle, start_i, end_i, range_start, range_end):
-        num_bundles = len(self.bundles)
-        bundleIdBytes = binaryIO.findNumBytes(num_bundles)
-        numBytes = binaryIO.readVal(filehandle, 1)
-        length = binaryIO.readVal(filehandle, numBytes)
-
         unpaired = []
         paired = []
 
-        if length > 0:
-            index = self.expandString(filehandle.read(length))
-            num_buckets, startPos = binaryIO.binaryToVal(index, 4, start=0)
-            chunk_size, startPos = binaryIO.binaryToVal(index, 2, startPos)
-            readLenBytes, startPos = binaryIO.binaryToVal(index, 1, startPos)
-            buckets, startPos = binaryIO.readCrossBundleBucketNames(index, num_buckets, bundleIdBytes, startPos)
-            chunk_lens, startPos = binaryIO.readList(index, startPos)
-
-            curr_bucket = 0
-            skip = 0
-            for l in chunk_lens:
-                buckets_in_chunk = min(chunk_size, num_buckets-curr_bucket)
-                relevant = [0] * buckets_in_chunk
-                last_relevant = -1
-
-                for i in range(buckets_in_chunk):
-                    bundleA = buckets[i+curr_bucket].bundleA
-                    bundleB = buckets[i+curr_bucket].bundleB
-                    if (bundleA >= start_i and bundleA < end_i) or (bundleB >= start_i and bundleB < end_i):
-                        relevant[i] = 1
-                        last_relevant = i
-
-                if last_relevant == -1:
-                    skip += l
-                else:
-                    if skip > 0:
-                        filehandle.seek(skip, 1)
-                        skip = 0
-
-                    chunk = self.expandString(filehandle.read(l))
-                    startPos = 0
-
-                    for i in range(last_relevant):
-
-                        if relevant[i]:
-                            b = buckets[i+curr_bucket]
-                            startPos = binaryIO.readCrossBundleBucket(chunk, b, readLenBytes, startPos)
-                            b.coverage = self.RLEtoVector(b.coverage)
-
-                            exonsA = self.bundles[b.bundleA]
-                            exonsB = self.bundles[b.bundleB]
-                            exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
-                            b.exon_bounds = exon_bounds
-
-                            boundaries = [exon_bounds[0][1]-exon_bounds[0][0]]
-                            for n in range(1, len(exon_bounds)):
-                                boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
-                            b.boundaries = boundaries
-
-                            self.getCrossBucketReads(b, range_start, range_end, unpaired, paired)
+        for b in self.readCrossBundleBuckets(filehandle, start_i, end_i):
+            b.coverage = self.RLEtoVector(b.coverage)
 
-                        else:
-                            startPos = binaryIO.skipCrossBundleBucket(chunk, readLenBytes, startPos)
+            exonsA = self.bundles[b.bundleA]
+            exonsB = self.bundles[b.bundleB]
+            exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
+            b.exon_bounds = exon_bounds
 
-                curr_bucket += buckets_in_chunk
+            boundaries = [exon_bounds[0][1]-exon_bounds[0][0]]
+            for n in range(1, len(exon_bounds)):
+                boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
+            b.boundaries = boundaries
 
-            if skip > 0:
-                filehandle.seek(skip, 1)
+            self.getCrossBucketReads(b, range_start, range_end, unpaired, paired)
 
         return unpaired, paired
 
@@ -927,8 +1100,9 @@ class Expander:
                 paired_reads.append(pairedread.PairedRead(self.aligned.getChromosome(readExonsA[0][0]), readExonsA, self.aligned.getChromosome(readExonsB[0][0]), readExonsB, bucket.strand, bucket.NH))
 
     def getBundleReads(self, f, length, range_start, range_end, unpaired, paired):
-        bundle = self.expandString(f.read(length))
+        bundle, lens = self.readBundle(f, length)
         startPos = 0
+        lensPos = 0
         readLenBytes, startPos = binaryIO.binaryToVal(bundle, 1, startPos)
         sorted_buckets, exonBytes, startPos = binaryIO.readJunctionsList(bundle, startPos)
 
@@ -945,7 +1119,7 @@ class Expander:
 
             # If the junction does not overlap the target region, skip it
             if not relevant:
-                startPos = binaryIO.skipJunction(bundle, readLenBytes, startPos)
+                startPos, lensPos = self.skipBundleBucket(bundle, lens, readLenBytes, startPos, lensPos)
                 continue
 
             # Otherwise, expand this junction
@@ -964,7 +1138,8 @@ class Expander:
                         boundaries.append(boundaries[-1] + subexon_length)
 
             # Read the rest of the junction information
-            b, startPos = binaryIO.readJunction(bundle, bucket.Bucket(exons, length, boundaries), readLenBytes, startPos)
+            b = bucket.Bucket(exons, length, boundaries)
+            startPos, lensPos = self.readBundleBucket(bundle, lens, b, readLenBytes, startPos, lensPos)
             b.NH = float(key[-1])
             b.strand = key[-2]
             b.coverage = self.RLEtoVector(b.coverage)
@@ -1089,7 +1264,9 @@ class Expander:
 
     def getCounts(self, compressed, gtf):
         start_t = time.time()
-        with open(compressed, 'rb') as f:
+        with binaryIO.MappedReader(compressed) as f:
+            compress_method, zdict, cross_bundle_start, self.formatVersion = binaryIO.seekFooter(f)
+            self.setCompressMethod(compress_method, zdict)
             chromosomes = binaryIO.readChroms(f)
             self.aligned = alignments.Alignments(chromosomes)
             transcripts = self.parseGTF(gtf, self.aligned.chromOffsets)
@@ -1113,7 +1290,7 @@ class Expander:
             exon_counts = [[e[0], e[1], 0] for e in sorted(list(exons))]
             junc_counts = [[e[0], e[1], 0] for e in sorted(list(juncs))]
 
-            self.bundles = binaryIO.readClusters(f)
+            self.bundles = binaryIO.readClusters(f, self.formatVersion)
             print('Sorting exons and junctions time: %fs' % (time.time()-start_t))
 
             '''
@@ -1175,10 +1352,12 @@ class Expander:
             spliced_index = binaryIO.readListFromFile(f)
 
             t = time.time()
+            f.seek(cross_bundle_start)
             self.getCrossBundleCounts(f, transcripts, exon_counts, junc_counts, overlapping_exons, overlapping_juncs)
             print('Cross bundle time: %fs' % (time.time()-t))
 
             t = time.time()
+            f.seek(0)
             for i in range(len(spliced_index)):
                 self.aligned.exons = self.bundles[i]
                 self.getBundleCounts(f, spliced_index[i], transcripts, exon_counts, junc_counts, overlapping_exons[i], overlapping_juncs[i])
@@ -1191,80 +1370,57 @@ class Expander:
         return exon_counts, junc_counts
 
     def getCrossBundleCounts(self, filehandle, transcripts, exon_counts, junc_counts, overlapping_exons, overlapping_juncs):
-        num_bundles = len(self.bundles)
-        bundleIdBytes = binaryIO.findNumBytes(num_bundles)
-        numBytes = binaryIO.readVal(filehandle, 1)
-        length = binaryIO.readVal(filehandle, numBytes)
+        for b in self.readCrossBundleBuckets(filehandle):
+            count = 0
+            total_len = 0
+            for l,f in b.lensLeft.items():
+                count += f
+                total_len += l * f
+            for l,f in b.lensRight.items():
+                count += f
+                total_len += l * f
+            avg_len = total_len / count
 
-        if length > 0:
-            index = self.expandString(filehandle.read(length))
-            num_buckets, startPos = binaryIO.binaryToVal(index, 4, start=0)
-            chunk_size, startPos = binaryIO.binaryToVal(index, 2, startPos)
-            readLenBytes, startPos = binaryIO.binaryToVal(index, 1, startPos)
-            buckets, startPos = binaryIO.readCrossBundleBucketNames(index, num_buckets, bundleIdBytes, startPos)
-            chunk_lens, startPos = binaryIO.readList(index, startPos)
+            exonsA = self.bundles[b.bundleA]
+            exonsB = self.bundles[b.bundleB]
+            exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
 
-            curr_bucket = 0
-            for l in chunk_lens:
-                buckets_in_chunk = min(chunk_size, num_buckets-curr_bucket)
-                chunk = self.expandString(filehandle.read(l))
-                startPos = 0
-
-                for i in range(buckets_in_chunk):
-                    b = buckets[i+curr_bucket]
-                    startPos = binaryIO.readCrossBundleBucket(chunk, b, readLenBytes, startPos)
-
-                    count = 0
-                    total_len = 0
-                    for l,f in b.lensLeft.items():
-                        count += f
-                        total_len += l * f
-                    for l,f in b.lensRight.items():
-                        count += f
-                        total_len += l * f
-                    avg_len = total_len / count
-
-                    exonsA = self.bundles[b.bundleA]
-                    exonsB = self.bundles[b.bundleB]
-                    exon_bounds = [(exonsA[e], exonsA[e+1]) for e in b.exonIdsA] + [(exonsB[e], exonsB[e+1]) for e in b.exonIdsB]
-
-                    boundaries = [0]
-                    for n in range(len(exon_bounds)):
-                        boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
-
-                    for i in range(len(exon_bounds)):
-                        start = exon_bounds[i][0]
-                        end = exon_bounds[i][1]
-
-                        for j in range(overlapping_exons[b.bundleA][0], overlapping_exons[b.bundleA][1]):
-                            if exon_counts[j][0] < end and exon_counts[j][1] > start:
-                                startOffset = min(0, exon_counts[j][0]-start)
-                                l = min(exon_counts[j][1], end) - startOffset
-                                cov = self.sumCov(b.coverage, boundaries[i]+startOffset, boundaries[i]+startOffset+l)
-                                exon_counts[j][2] += float(cov) / (avg_len * b.NH)
-                        for j in range(overlapping_exons[b.bundleB][0], overlapping_exons[b.bundleB][1]):
-                            if exon_counts[j][0] < end and exon_counts[j][1] > start:
-                                startOffset = min(0, exon_counts[j][0]-start)
-                                l = min(exon_counts[j][1], end) - startOffset
-                                cov = self.sumCov(b.coverage, boundaries[i]+startOffset, boundaries[i]+startOffset+l)
-                                exon_counts[j][2] += float(cov) / (avg_len * b.NH)
-
-                        for j in range(overlapping_juncs[b.bundleA][0], overlapping_juncs[b.bundleA][0]):
-                            if junc_counts[j][0] == end and i < (len(exon_bounds)-1) and junc_counts[j][1] == exon_bounds[i+1][0]:
-                                    v = min(self.getCov(b.coverage, boundaries[i]-1), self.getCov(b.coverage, boundaries[i]))
-                                    junc_counts[j][2] += float(v) / b.NH
-                        for j in range(overlapping_juncs[b.bundleB][0], overlapping_juncs[b.bundleB][1]):
-                            if junc_counts[j][0] == end and i < (len(exon_bounds)-1) and junc_counts[j][1] == exon_bounds[i+1][0]:
-                                    v = min(self.getCov(b.coverage, boundaries[i]-1), self.getCov(b.coverage, boundaries[i]))
-                                    junc_counts[j][2] += float(v) / b.NH
-
-                curr_bucket += buckets_in_chunk
+            boundaries = [0]
+            for n in range(len(exon_bounds)):
+                boundaries.append(boundaries[-1] + exon_bounds[n][1]-exon_bounds[n][0])
+
+            for i in range(len(exon_bounds)):
+                start = exon_bounds[i][0]
+                end = exon_bounds[i][1]
+
+                for j in range(overlapping_exons[b.bundleA][0], overlapping_exons[b.bundleA][1]):
+                    if exon_counts[j][0] < end and exon_counts[j][1] > start:
+                        startOffset = min(0, exon_counts[j][0]-start)
+                        l = min(exon_counts[j][1], end) - startOffset
+                        cov = self.sumCov(b.coverage, boundaries[i]+startOffset, boundaries[i]+startOffset+l)
+                        exon_counts[j][2] += float(cov) / (avg_len * b.NH)
+                for j in range(overlapping_exons[b.bundleB][0], overlapping_exons[b.bundleB][1]):
+                    if exon_counts[j][0] < end and exon_counts[j][1] > start:
+                        startOffset = min(0, exon_counts[j][0]-start)
+                        l = min(exon_counts[j][1], end) - startOffset
+                        cov = self.sumCov(b.coverage, boundaries[i]+startOffset, boundaries[i]+startOffset+l)
+                        exon_counts[j][2] += float(cov) / (avg_len * b.NH)
+
+                for j in range(overlapping_juncs[b.bundleA][0], overlapping_juncs[b.bundleA][0]):
+                    if junc_counts[j][0] == end and i < (len(exon_bounds)-1) and junc_counts[j][1] == exon_bounds[i+1][0]:
+                            v = min(self.getCov(b.coverage, boundaries[i]-1), self.getCov(b.coverage, boundaries[i]))
+                            junc_counts[j][2] += float(v) / b.NH
+                for j in range(overlapping_juncs[b.bundleB][0], overlapping_juncs[b.bundleB][1]):
+                    if junc_counts[j][0] == end and i < (len(exon_bounds)-1) and junc_counts[j][1] == exon_bounds[i+1][0]:
+                            v = min(self.getCov(b.coverage, boundaries[i]-1), self.getCov(b.coverage, boundaries[i]))
+                            junc_counts[j][2] += float(v) / b.NH
 
         return
 
     def getBundleCounts(self, f, length, transcripts, exon_counts, junc_counts, overlapping_exons, overlapping_juncs):
-        bundle = self.expandString(f.read(length))
+        bundle, lens = self.readBundle(f, length)
         startPos = 0
+        lensPos = 0
         readLenBytes, startPos = binaryIO.binaryToVal(bundle, 1, startPos)
         sorted_buckets, exonBytes, startPos = binaryIO.readJunctionsList(bundle, startPos)
 
@@ -1289,7 +1445,8 @@ class Expander:
                     else:
                         boundaries.append(boundaries[-1] + subexon_length)
 
-            b, startPos = binaryIO.readJunction(bundle, bucket.Bucket(bucket_exons, length, boundaries), readLenBytes, startPos)
+            b = bucket.Bucket(bucket_exons, length, boundaries)
+            startPos, lensPos = self.readBundleBucket(bundle, lens, b, readLenBytes, startPos, lensPos)
             #print(b.coverage)
             b.NH = float(key[-1])
 
@@ -13,8 +13,9 @@ class BIterator:
             print("I/O error({0}): {1}".format(e.errno, e.strerror))
 
         # Read index
+        self.compressMethod, self.zdict, cross_bundle_index_start, self.formatVersion = binaryIO.seekFooter(self.f)
         self.chromosomes = binaryIO.readChroms(self.f)
-        self.bundles = binaryIO.readClusters(self.f)
+        self.bundles = binaryIO.readClusters(self.f, self.formatVersion)
         self.spliced_index = binaryIO.readListFromFile(f)
 
         self.curr_cluster = 0
@@ -23,6 +24,7 @@ class BIterator:
         # Read index for cross-bundle buckets
         num_bundles = len(self.bundles)
         bundleIdBytes = binaryIO.findNumBytes(num_bundles)
+        self.f.seek(cross_bundle_index_start)
         numBytes = binaryIO.readVal(self.f, 1)
         length = binaryIO.readVal(self.f, numBytes)
         index = self.expandString(self.f.read(length))
@@ -86,7 +88,7 @@ class BIterator:
                 for i in range(last_relevant+1):
                     if relevant[i]:
                         b = self.cross_bundle_buckets[i+curr_bucket]
-                        startPos = binaryIO.readCrossBundleBucket(chunk, b, self.readLenBytes, startPos)
+                        startPos = binaryIO.readCrossBundleBucket(chunk, b, self.readLenBytes, startPos, self.formatVersion)
                         b.coverage = self.RLEtoVector(b.coverage)
 
                         exonsA = self.bundles[b.bundleA]
@@ -100,7 +102,7 @@ class BIterator:
 
                         coverage = self.getBucketCoverage(b, coverage, range_start, range_end, exon_bounds, boundaries)
                     else:
-                        startPos = binaryIO.skipCrossBundleBucket(chunk, self.readLenBytes, startPos)
+                        startPos = binaryIO.skipCrossBundleBucket(chunk, self.readLenBytes, startPos, self.formatVersion)
 
             curr_bucket += buckets_in_chunk
 
@@ -1,63 +1,77 @@
 # Contains functions for the first pass over the alignments file to determine the fragment length distribution, establish a cutoff for long fragments, and determine pairing
 import math
-import re
+import samIO
+import itertools
 
 class Preprocessor:
+    # When preprocessing in the same pass as compression, number of alignments read ahead to estimate the fragment length cutoff
+    warmup_reads = 100000
+
+    # When preprocessing in the same pass as compression, minimum number of alignments between updates to the fragment length cutoff
+    update_interval = 1000000
+
     def __init__(self, samFilename, cutoff_z, split_diff_strand):
+        '''
+        If samFilename is None, no pass is made over the file. Instead, alignments are passed to process_alignment() as they are compressed.
+        '''
+
         #self.num_reads = sum(1 for line in open(samFilename))
         self.frag_len_cutoff = None
 
-        self.preprocess(samFilename, cutoff_z, split_diff_strand)
+        self.start(cutoff_z)
 
-    def preprocess(self, samFilename, cutoff_z, split_diff_strand):
+        if samFilename:
+            self.preprocess(samFilename, cutoff_z, split_diff_strand)
+
+    def start(self, cutoff_z):
         '''
-        Make a first pass over the file
+        Initialize the fragment length distribution, pairing information and sort check
         '''
 
         # For counting fragment lengths
-        find_cutoff = False
+        self.cutoff_z = cutoff_z
+        self.find_cutoff = False
         if not cutoff_z == None:
-            find_cutoff = True
-            self.lens = dict()
-            self.len_sum = 0
+            self.find_cutoff = True
+        self.reset_frag_lens()
 
         # For determining pairs
         #self.pairing = ['-1'] * self.num_reads
         self.unpaired = []
         self.unmatched = dict()
 
-        lastChrom = None
-        lastPos = 0
+        self.lastChrom = None
+        self.lastPos = 0
+
+    def reset_frag_lens(self):
+        self.lens = dict()
+        self.len_sum = 0
+        self.num_reads = 0
+        self.last_update = 0
+
+    def preprocess(self, samFilename, cutoff_z, split_diff_strand):
+        '''
+        Make a first pass over the file
+        '''
+
         with open(samFilename, 'r') as f:
             id = 0
             for line in f:
                 if line[0] == '@':
                     continue
 
-                row = line.rstrip().split('\t')
-
-                chrom = row[2]
-                pos = int(row[3])
-                if chrom == lastChrom and pos < lastPos:
-                    print('Error! SAM file appears to be unsorted.')
-                    print('Found a read at %s:%d after a read at %s:%d' % (chrom, pos, lastChrom, lastPos))
-                    exit()
-                lastChrom = chrom
-                lastPos = pos
+                row = samIO.splitRow(line)
 
-                if find_cutoff and row[6] == '=':
-                    self.process_frag_lens(int(row[7]) - int(row[3]))
+                self.process_alignment(row[2], int(row[3]), row[6], int(row[7]))
 
                 if not row[6] == '*':
                     self.process_pairs(id, row)
 
                 id += 1
 
-        self.num_reads = id
-
         self.unpaired.sort()
 
-        if find_cutoff:
+        if self.find_cutoff:
             self.calculate_cutoff(cutoff_z)
         #self.reprocess_pairs(split_diff_strand)
 
@@ -66,6 +80,63 @@ class Preprocessor:
         #with open('pairs.txt', 'w') as f:
         #    f.write('\n'.join(self.pairing))
 
+    def process_alignment(self, chrom, pos, mate_chrom, mate_pos):
+        '''
+        Check that the alignment is sorted and add it to the fragment length distribution
+        '''
+
+        if chrom == self.lastChrom and pos < self.lastPos:
+            print('Error! SAM file appears to be unsorted.')
+            print('Found a read at %s:%d after a read at %s:%d' % (chrom, pos, self.lastChrom, self.lastPos))
+            exit()
+        self.lastChrom = chrom
+        self.lastPos = pos
+
+        if self.find_cutoff and mate_chrom == '=':
+            self.process_frag_lens(mate_pos - pos)
+
+        self.num_reads += 1
+
+    def estimate_cutoff(self, alignments):
+        '''
+        Estimate the fragment length cutoff from the first alignments in a stream, before any of them are compressed.
+
+        :param alignments: Iterator over alignments in the form returned by Compressor.parseSAMAlignments()
+        :return: Iterator over all alignments, including those that were read ahead
+        '''
+
+        buffered = []
+        for alignment in alignments:
+            buffered.append(alignment)
+            _, _, _, pos, _, _, _, mate_chrom, mate_pos = alignment
+            if self.find_cutoff and mate_chrom == '=':
+                self.process_frag_lens(mate_pos - pos)
+            self.num_reads += 1
+
+            if self.num_reads >= self.warmup_reads:
+                break
+
+        self.calculate_cutoff(self.cutoff_z)
+
+        # The buffered alignments are counted again as they are compressed
+        self.reset_frag_lens()
+
+        return itertools.chain(buffered, alignments)
+
+    def update_cutoff(self):
+        '''
+        Recalculate the fragment length cutoff if enough alignments have been processed since it was last updated
+
+        :return: True if the cutoff was updated
+        '''
+
+        if not self.find_cutoff or self.num_reads < self.last_update + self.update_interval:
+            return False
+
+        self.calculate_cutoff(self.cutoff_z, False)
+        self.last_update = self.num_reads
+        return True
+
     def process_pairs(self, id, row):
         name = row[0]
         chrom = row[2]
@@ -78,12 +149,11 @@ class Preprocessor:
 
         # -1 = negative strand, 1 = positive, 0 = unknown
         strand = 0
-        for r in row[11:]:
-            if r[:5] == 'XS:A:':
-                if r[5] == '+':
-                    strand = 1
-                elif r[5] == '-':
-                    strand = -1
+        xs, _ = samIO.parseTags(row[11])
+        if xs == '+':
+            strand = 1
+        elif xs == '-':
+            strand = -1
 
 
         if name in self.unmatched:
@@ -155,7 +225,7 @@ class Preprocessor:
         else:
             self.lens[frag_len] = 1
 
-    def calculate_cutoff(self, cutoff_z):
+    def calculate_cutoff(self, cutoff_z, verbose=True):
         if self.num_reads == 0:
             self.frag_len_cutoff = 0
             return
@@ -168,6 +238,9 @@ class Preprocessor:
         stdev = math.sqrt(stdev / self.num_reads)
         self.frag_len_cutoff = int(avg + cutoff_z * stdev)
 
+        if not verbose:
+            return
+
         print('Set fragment length cutoff to z=%f (%d) based on length distribution' % (cutoff_z, self.frag_len_cutoff))
         count_longer = 0
         for l,f in self.lens.items():
@@ -212,36 +285,3 @@ class Preprocessor:
                     return 2
 
         return 0
-
-    '''
-    def parseCigar(self, cigar, offset):
-        exons = []
-        newExon = True
-
-        # Parse cigar string
-        match = re.search("\D", cigar)
-        while match:
-            index = match.start()
-            length = int(''.join(cigar[:index]))
-
-            if cigar[index] == 'N':
-                # Separates contiguous exons, so set boolean to start a new one
-                newExon = True
-            elif cigar[index] == 'M':
-                # If in the middle of a contiguous exon, append the length to it, otherwise start a new exon
-                if newExon:
-                    exons.append([offset, offset+length])
-                    newExon = False
-                else:
-                    exons[-1][1] += length
-            elif cigar[index] == 'D':
-                # If in the middle of a contiguous exon, append the deleted length to it
-                if not newExon:
-                    exons[-1][1] += length
-
-            offset += length
-            cigar = cigar[index+1:]
-            match = re.search("\D", cigar)
-
-        return exons
-    '''
@@ -1,5 +1,5 @@
 #! /usr/bin/env python3
-import re
+import samIO
 
 class ReadSAM:
     '''
@@ -30,9 +30,9 @@ class ReadSAM:
             coverage = [0.0] * (end-start)
 
             for line in f:
-                row = line.rstrip().split('\t')
+                row = samIO.splitRow(line)
 
-                if len(row) < 10:
+                if len(row) < 11:
                     continue
 
                 if row[2] == chrom:
@@ -40,13 +40,11 @@ class ReadSAM:
                     cigar = row[5]
 
                     if readStart < end:
-                        exons = self.parseCigar(cigar, readStart)
+                        exons = samIO.parseCigar(cigar, readStart)
 
                         if exons[-1][1] > start:
-                            NH = 1.0
-                            for s in row:
-                                if s[:5] == 'NH:i:':
-                                    NH = 1.0 / float(s[5:])
+                            _, NH = samIO.parseTags(row[11])
+                            NH = 1.0 / float(NH)
 
                             for e in exons:
                                 if e[0] < end and e[1] >= start:
@@ -85,9 +83,9 @@ class ReadSAM:
         sawChrom = False # Set this flag to true after we've seen the first read from chrom
         with open(self.filename, 'r') as f:
             for line in f:
-                row = line.rstrip().split('\t')
+                row = samIO.splitRow(line)
 
-                if len(row) < 10:
+                if len(row) < 11:
                     continue
 
                 if row[2] == chrom:
@@ -106,12 +104,7 @@ class ReadSAM:
                         #if readStart >= end and pairStart >= end:
                         #    continue
 
-                        NH = 1
-                        for r in row[11 : len(row)]:
-                            if r[0:5] == 'XS:A:' or r[0:5] == 'XS:a:':
-                                xs = r[5]
-                            elif r[0:3] == 'NH:':
-                                NH = int(r[5:])
+                        xs, NH = samIO.parseTags(row[11])
 
 
                         if row[0] in unmatched:
@@ -119,8 +112,8 @@ class ReadSAM:
                             m = unmatched[row[0]]
                             for i in range(len(m)):
                                 if m[i][0] == pairStart and m[i][2] == readStart and m[i][3] == NH:
-                                    r1 = self.parseCigar(m[i][1], m[i][0]+offset)
-                                    r2 = self.parseCigar(cigar, readStart+offset)
+                                    r1 = samIO.parseCigar(m[i][1], m[i][0]+offset)
+                                    r2 = samIO.parseCigar(cigar, readStart+offset)
 
                                     if self.readOverlapsRegion(r1, start, end) or self.readOverlapsRegion(r2, start, end):
                                         paired.append([r1, r2])
@@ -133,16 +126,11 @@ class ReadSAM:
                         else:
                             unmatched[row[0]] = [(readStart, cigar, pairStart, NH)]
                     else:
-                        exons = self.parseCigar(cigar, readStart+offset)
+                        exons = samIO.parseCigar(cigar, readStart+offset)
 
                         if readStart < end and exons[-1][1] > start:
                             if self.readOverlapsRegion(exons, start, end):
-                                NH = 1
-                                for r in row[11 : len(row)]:
-                                    if r[0:5] == 'XS:A:' or r[0:5] == 'XS:a:':
-                                        xs = r[5]
-                                    elif r[0:3] == 'NH:':
-                                        NH = int(r[5:])
+                                xs, NH = samIO.parseTags(row[11])
                                 unpaired.append(exons)
                 else:
                     if sawChrom:
@@ -175,7 +163,7 @@ class ReadSAM:
         genes = []
         with open(self.filename, 'r') as f:
             for line in f:
-                row = line.rstrip().split('\t')
+                row = samIO.splitRow(line)
 
                 if len(row) < 10:
                     continue
@@ -191,7 +179,7 @@ class ReadSAM:
                     else:
                         cigar = row[5]
                         if readStart >= start and readStart < end:
-                            exons = self.parseCigar(cigar, readStart)
+                            exons = samIO.parseCigar(cigar, readStart)
 
                             if exons[-1][1] <= end:
                                 genes.append((exons[0][0], exons[-1][1]))
@@ -207,39 +195,3 @@ class ReadSAM:
                 i += 1
 
         return genes
-
-
-    def parseCigar(self, cigar, offset):
-        ''' Parse the cigar string starting at the given index of the genome
-            Returns a list of offsets for each exonic region of the read [(start1, end1), (start2, end2), ...]
-        '''
-        exons = []
-        newExon = True
-
-        # Parse cigar string
-        match = re.search("\D", cigar)
-        while match:
-            index = match.start()
-            length = int(''.join(cigar[:index]))
-
-            if cigar[index] == 'N':
-                # Separates contiguous exons, so set boolean to start a new one
-                newExon = True
-            elif cigar[index] == 'M':
-                # If in the middle of a contiguous exon, append the length to it, otherwise start a new exon
-                if newExon:
-                    exons.append([offset, offset+length])
-                    newExon = False
-                else:
-                    exons[-1][1] += length
-            elif cigar[index] == 'D':
-                # If in the middle of a contiguous exon, append the deleted length to it
-                if not newExon:
-                    exons[-1][1] += length
-
-            if not cigar[index] == 'S':
-                offset += length
-            cigar = cigar[index+1:]
-            match = re.search("\D", cigar)
-
-        return exons
@@ -0,0 +1,144 @@
+import re
+
+# Splits a CIGAR string into (length, operation) pairs
+cigarPattern = re.compile(r'(\d+)(\D)')
+
+# XS (strand) and NH (number of hits) values among the optional fields of a SAM line
+xsPattern = re.compile(r'(?:^|\t)XS:[Aa]:(.)')
+nhPattern = re.compile(r'(?:^|\t)NH:.:(-?\d+)')
+
+# Exon layout of each CIGAR string seen so far, relative to the start of the read
+cigarCache = dict()
+
+# CIGAR string of each exon layout seen so far, relative to the start of the read, and whether it is spliced
+layoutCache = dict()
+
+# Maximum number of CIGAR strings to cache. The cache is cleared when it fills up
+maxCacheSize = 100000
+
+def parseCigar(cigar, offset):
+    ''' Parse the cigar string starting at the given index of the genome
+        Returns a list of offsets for each exonic region of the read [(start1, end1), (start2, end2), ...]
+    '''
+
+    layout = cigarCache.get(cigar)
+    if layout == None:
+        if len(cigarCache) >= maxCacheSize:
+            cigarCache.clear()
+        layout = cigarLayout(cigar)
+        cigarCache[cigar] = layout
+
+    return [[offset+start, offset+end] for start, end in layout]
+
+def cigarLayout(cigar):
+    ''' Return the exons in a cigar string relative to the start of the read, as a tuple of (start, end) pairs
+    '''
+
+    exons = []
+    newExon = True
+    offset = 0
+
+    for length, op in cigarPattern.findall(cigar):
+        length = int(length)
+
+        if op == 'N':
+            # Separates contiguous exons, so set boolean to start a new one
+            newExon = True
+        elif op == 'M':
+            # If in the middle of a contiguous exon, append the length to it, otherwise start a new exon
+            if newExon:
+                exons.append([offset, offset+length])
+                newExon = False
+            else:
+                exons[-1][1] += length
+        elif op == 'D':
+            # If in the middle of a contiguous exon, append the deleted length to it
+            if not newExon:
+                exons[-1][1] += length
+
+        # Skip soft clipping
+        if not op == 'S':
+            offset += length
+
+    return tuple((e[0], e[1]) for e in exons)
+
+def cigarLength(cigar):
+    ''' Return the number of reference bases covered by matches and deletions in a cigar string
+    '''
+
+    return sum(int(length) for length, op in cigarPattern.findall(cigar) if op == 'M' or op == 'D')
+
+def splitRow(line):
+    ''' Split a SAM line into its 11 mandatory fields followed by a single string containing all optional fields, which is empty if there are none
+    '''
+
+    row = line.rstrip().split('\t', 11)
+    if len(row) == 11:
+        row.append('')
+    return row
+
+def parseTags(tags):
+    ''' Find the XS and NH values in the optional fields of a SAM line, as returned in the last field by splitRow()
+
+        :return: XS value (or None) and NH value (default 1)
+    '''
+
+    match = xsPattern.search(tags)
+    if match:
+        strand = match.group(1)
+    else:
+        strand = None
+
+    match = nhPattern.search(tags)
+    if match:
+        NH = int(match.group(1))
+    else:
+        NH = 1
+
+    return strand, NH
+
+def exonsToCigar(exons):
+    ''' Return the cigar string for a read with the given exons [(start1, end1), (start2, end2), ...] and True if the read is spliced.
+        Adjacent exons are merged into a single match
+    '''
+
+    start = exons[0][0]
+    if len(exons) == 1:
+        layout = exons[0][1] - start
+    else:
+        layout = tuple(x - start for e in exons for x in e)
+
+    cigar = layoutCache.get(layout)
+    if cigar == None:
+        if len(layoutCache) >= maxCacheSize:
+            layoutCache.clear()
+        cigar = layoutCigar(exons)
+        layoutCache[layout] = cigar
+
+    return cigar
+
+def layoutCigar(exons):
+    ''' Build the cigar string for a read with the given exons, as returned by exonsToCigar()
+    '''
+
+    lengths, ops, spliced = cigarOps(exons)
+    return ''.join([str(lengths[i]) + ops[i] for i in range(len(ops))]), spliced
+
+def cigarOps(exons):
+    ''' Return the lengths and operations ('M' or 'N') of the cigar string for a read with the given exons, and True if the read is spliced
+    '''
+
+    lengths = [exons[0][1] - exons[0][0]]
+    ops = ['M']
+    spliced = False
+    for i in range(1, len(exons)):
+        if exons[i][0] == exons[i-1][1]:
+            lengths[-1] += exons[i][1] - exons[i][0]
+        else:
+            spliced = True
+            lengths.append(exons[i][0] - exons[i-1][1])
+            ops.append('N')
+            lengths.append(exons[i][1] - exons[i][0])
+            ops.append('M')
+
+    return lengths, ops, spliced